@@ -0,0 +1,477 @@
+"Seeded benchmark workloads for the solvers in this collection, with results written as JSON."
+
+from collections import OrderedDict
+from cStringIO import StringIO
+from math import factorial
+from multiprocessing import Pool
+import cProfile
+import json
+import os
+import pstats
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import clickomania_solver
+import permutations
+import permutations_knuth
+import simple_db
+import sudoku_solver
+
+SEED = 0
+PROFILE_LINES = 25
+NUM_SUDOKU_PUZZLES = 100
+NUM_SUDOKU_SOLVES = 10
+NUM_LARGE_SUDOKU_PUZZLES = 15
+PERMUTATION_WORDS = ['abcdef', 'abcdefg', 'abcdefgh', 'abcdefghi', 'abcdefghij', 'aabbccdde']
+PERMUTATION_KERNEL_WORD = 'abcdefghij'
+PERMUTATION_KERNEL_LIMIT = 10 ** 6
+NUM_DB_COMMANDS = 200000
+NUM_DB_KEYS = 200000
+DB_TRANSACTION_DEPTH = 1000
+NUM_DB_QUERIES = 100
+DB_VALUE_SKEW = 0.5
+NUM_DB_SERVER_CONNECTIONS = 4
+NUM_DB_SERVER_REQUESTS = 20000
+CLICKOMANIA_BOARD = '''
+    12 20 3
+    GGGYBIBBGYBGYBIYIIYB
+    GYGIGIGBBGGYIGYGBGBG
+    IYBBBGGYGBGBGYBYGYII
+    BYIYYYYBBGBIGIIGGYBB
+    BBYIIGGGGBGGIIGYGBYG
+    GGBYBYGBBGIBBYYBGGBY
+    GBGIYYYIIBGYGGBIYYBY
+    IBYIIYYYBIYGGYYYGIIG
+    YGBBYIGIGIBYYYGGGGGY
+    GYBYIIBYIGYGGIBBBBBB
+    BYGYIIGYGYBBGYGIYIBG
+    GIYBGIGIGYIGIYYYIYYY
+    '''
+CLICKOMANIA_BOARDS = ([(8, 8, 3)] * 5 + [(8, 8, 4)] * 3 + [(10, 12, 4)] * 2)
+NUM_GROUP_FINDING_ROUNDS = 200
+NUM_SERVER_BOARDS = 20
+
+
+def get_script(module):
+    "Returns path of module's source file (to run it as a script)."
+    return os.path.splitext(module.__file__)[0] + '.py'
+
+
+def sudoku_puzzles(num_puzzles=NUM_SUDOKU_PUZZLES, num_solves=NUM_SUDOKU_SOLVES):
+    "Returns a job solving each of num_puzzles generated hard 9x9 puzzles num_solves times."
+    puzzles = [sudoku_solver.generate_unique_puzzle() for _ in xrange(num_puzzles)]
+    return lambda: len([sudoku_solver.solve_sudoku(puzzle)
+                        for _ in xrange(num_solves) for puzzle in puzzles])
+
+
+def sudoku_blanked(box_size, fraction_blank, num_puzzles=NUM_SUDOKU_PUZZLES):
+    "Returns a job solving num_puzzles random solutions with fraction_blank of their cells blank."
+    dimension = box_size * box_size
+    puzzles = []
+    for _ in xrange(num_puzzles):
+        puzzle = sudoku_solver.generate_solution(box_size)
+        for index in random.sample(xrange(dimension * dimension),
+                                   int(fraction_blank * dimension * dimension)):
+            puzzle[index / dimension][index % dimension] = 0
+        puzzles.append(puzzle)
+    return lambda: len([sudoku_solver.solve_sudoku(puzzle, box_size) for puzzle in puzzles])
+
+
+def read_clickomania_board():
+    "Returns CLICKOMANIA_BOARD as a Grid."
+    lines = iter(CLICKOMANIA_BOARD.strip().split('\n'))
+    return clickomania_solver.read_grid(lambda: next(lines))
+
+
+def random_clickomania_grid(num_rows, num_columns, num_colors):
+    "Returns a full grid of random colors."
+    grid = clickomania_solver.Grid(num_rows, num_columns, num_colors, 0)
+    return grid.replace(bits=sum(random.randint(1, num_colors)
+                                 << clickomania_solver.xy_to_bit_position(x_coord, y_coord, grid)
+                                 for x_coord in xrange(num_rows)
+                                 for y_coord in xrange(num_columns)))
+
+
+def clickomania_board(strategy):
+    "Returns a job finding all moves for the 12x20 board with strategy."
+    grid = read_clickomania_board()
+
+    def job():
+        "Runs the search."
+        clickomania_solver.get_all_moves(grid, strategy)
+        return 1
+    return job
+
+
+def clickomania_boards(strategy):
+    "Returns a job finding all moves with strategy for a random board per CLICKOMANIA_BOARDS size."
+    grids = [random_clickomania_grid(*size) for size in CLICKOMANIA_BOARDS]
+
+    def job():
+        "Runs the searches."
+        for grid in grids:
+            clickomania_solver.get_all_moves(grid, strategy)
+        return len(grids)
+    return job
+
+
+def clickomania_child_groups(incremental, num_rounds=NUM_GROUP_FINDING_ROUNDS):
+    """
+        Returns a job finding the groups of every child of the 12x20 board num_rounds times, from
+        scratch or (if incremental is set) from the board's groups (see get_child_group_masks).
+    """
+    grid = read_clickomania_board()
+    masks = clickomania_solver.get_group_masks(grid)
+    children = [(mask, clickomania_solver.collapse_mask(mask,
+                                                        clickomania_solver.clear_mask(mask, grid)))
+                for mask in masks]
+
+    def job():
+        "Finds the groups."
+        for _ in xrange(num_rounds):
+            for mask, child in children:
+                if incremental:
+                    clickomania_solver.get_child_group_masks(masks, mask, child)
+                else:
+                    clickomania_solver.get_group_masks(child)
+        return num_rounds * len(children)
+    return job
+
+
+def clickomania_server(num_boards=NUM_SERVER_BOARDS):
+    """
+        Returns a job playing num_boards random 8x8 boards to the end against a clickomania_solver
+        --serve process (over its stdin and stdout, with a new moves cache), a move per request.
+    """
+    directory = tempfile.mkdtemp()
+    server = subprocess.Popen([sys.executable, get_script(clickomania_solver), '--serve'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=directory)
+    grids = [random_clickomania_grid(8, 8, 3) for _ in xrange(num_boards)]
+
+    def job():
+        "Plays the boards, then stops the server."
+        num_moves = 0
+        try:
+            for grid in grids:
+                while True:
+                    server.stdin.write(clickomania_solver.format_grid(grid))
+                    server.stdin.flush()
+                    reply = server.stdout.readline().split()
+                    num_moves += 1
+                    if reply == ['NO', 'MOVE']:
+                        break
+                    grid = clickomania_solver.make_move(grid, int(reply[0]), int(reply[1]))
+        finally:
+            server.stdin.close()
+            server.wait()
+            shutil.rmtree(directory)
+        return num_moves
+    return job
+
+
+def permutation_words(module):
+    """
+        Returns a job writing every permutation of each of PERMUTATION_WORDS (to the null device)
+        the way module's script does. (permutations repeats permutations of repeated letters.)
+    """
+    def job():
+        "Writes the permutations."
+        with open(os.devnull, 'w') as outfile:
+            for word in PERMUTATION_WORDS:
+                if module is permutations_knuth:
+                    module.write_permutations(outfile, word)
+                else:
+                    module.write_permutations(outfile, module.permutations(word))
+                outfile.write('\n')
+        if module is permutations_knuth:
+            return sum(module.count(word) for word in PERMUTATION_WORDS)
+        return sum(factorial(len(word)) for word in PERMUTATION_WORDS)
+    return job
+
+
+def permutation_kernel(name, word=PERMUTATION_KERNEL_WORD, limit=PERMUTATION_KERNEL_LIMIT):
+    """
+        Returns a job stepping through the first limit permutations of word with the named
+        permutations_knuth kernel: 'views' (permutation_buffers) or 'records' (fill_records).
+    """
+    num_permutations = min(limit, permutations_knuth.count(word))
+    output = bytearray((len(word) + 1) * num_permutations)
+
+    def job():
+        "Steps through the permutations."
+        if name == 'views':
+            return sum(1 for _ in permutations_knuth.permutation_buffers(word, 0, num_permutations))
+        return permutations_knuth.fill_records(bytearray(word), output, num_permutations)
+    return job
+
+
+def db_commands(cls, num_commands=NUM_DB_COMMANDS):
+    "Returns a job running a random mix of num_commands commands through a new cls database."
+    names = ['name%d' % index for index in xrange(num_commands / 10)]
+    commands = []
+    for _ in xrange(num_commands):
+        operation = random.random()
+        if operation < 0.5:
+            commands.append('SET %s %d' % (random.choice(names), random.randrange(1000)))
+        elif operation < 0.75:
+            commands.append('GET %s' % random.choice(names))
+        elif operation < 0.85:
+            commands.append('UNSET %s' % random.choice(names))
+        elif operation < 0.95:
+            commands.append('NUMEQUALTO %d' % random.randrange(1000))
+        elif operation < 0.97:
+            commands.append('BEGIN')
+        elif operation < 0.985:
+            commands.append('ROLLBACK')
+        elif operation < 0.99:
+            commands.append('COMMIT')
+        else:
+            commands.append('TOPVALUES 10')
+
+    def job():
+        "Runs the commands."
+        simple_db.process_commands(cls(), commands)
+        return num_commands
+    return job
+
+
+def db_transactions(num_keys=NUM_DB_KEYS, depth=DB_TRANSACTION_DEPTH):
+    """
+        Returns a job setting num_keys keys in a transaction, then twice opening depth nested
+        transactions (each setting a key) and rolling them back the first time, committing them
+        the second.
+    """
+    def job():
+        "Runs the transactions."
+        database = simple_db.SimpleDb()
+        database.begin()
+        for index in xrange(num_keys):
+            database.put('key%d' % index, str(index % 10))
+        for finish in (simple_db.SimpleDb.rollback, simple_db.SimpleDb.commit):
+            for level in xrange(depth):
+                database.begin()
+                database.put('key%d' % level, 'level')
+            for level in xrange(depth):
+                finish(database)
+        return num_keys + 4 * depth
+    return job
+
+
+def db_durable(num_keys=NUM_DB_KEYS):
+    """
+        Returns a job setting num_keys keys in a new DurableSimpleDb (in a temporary directory),
+        then recovering it from its log, compacting it and recovering it from its snapshot.
+    """
+    def job():
+        "Sets the keys and recovers them."
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'db')
+            database = simple_db.DurableSimpleDb(path, compact_every=sys.maxint)
+            for index in xrange(num_keys):
+                database.put('key%d' % index, str(index % 10))
+            database.close()
+            for _ in xrange(2):
+                database = simple_db.DurableSimpleDb(path, compact_every=sys.maxint)
+                database.compact()
+                database.close()
+        finally:
+            shutil.rmtree(directory)
+        return num_keys
+    return job
+
+
+def db_queries(num_keys=NUM_DB_KEYS, num_queries=NUM_DB_QUERIES):
+    "Returns a job running num_queries each of KEYSWITH, RANGE and PREFIX over num_keys keys."
+    database = simple_db.SimpleDb()
+    database.put_many(('key%d' % index, str(index % 1000)) for index in xrange(num_keys))
+    values = [str(random.randrange(1000)) for _ in xrange(num_queries)]
+
+    def job():
+        "Runs the queries."
+        for value in values:
+            database.keys_with(value)
+            database.keys_in_range(value, value + '0')
+            database.keys_with_prefix('key' + value + '0')
+        return 3 * num_queries
+    return job
+
+
+def db_skewed_sets(cls, num_keys=NUM_DB_KEYS, num_sets=NUM_DB_COMMANDS, skew=DB_VALUE_SKEW):
+    """
+        Returns a job setting num_sets random names (out of num_keys) to Pareto-distributed (so
+        skewed) values in a new cls database, for comparing exact and approximate value counts.
+    """
+    items = [('key%d' % random.randrange(num_keys), str(int(random.paretovariate(skew))))
+             for _ in xrange(num_sets)]
+
+    def job():
+        "Sets the names."
+        database = cls()
+        for name, value in items:
+            database.put(name, value)
+        return num_sets
+    return job
+
+
+def send_db_requests(address, index, num_requests):
+    "Makes num_requests SET+GET round trips to a simple_db server at address, then ENDs."
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(address)
+    replies = connection.makefile('r')
+    for request in xrange(num_requests):
+        connection.sendall('SET c%d-%d %d\nGET c%d-%d\n' % (index, request, request,
+                                                            index, request))
+        replies.readline()
+    connection.sendall('END\n')
+    connection.close()
+
+
+def db_server(num_connections=NUM_DB_SERVER_CONNECTIONS, num_requests=NUM_DB_SERVER_REQUESTS):
+    """
+        Returns a job making num_requests SET+GET round trips, split across num_connections
+        concurrent connections, to a simple_db --serve process on a Unix socket.
+    """
+    directory = tempfile.mkdtemp()
+    address = os.path.join(directory, 'db.sock')
+    server = subprocess.Popen([sys.executable, get_script(simple_db), '--serve', address])
+    while not os.path.exists(address) and server.poll() is None:
+        time.sleep(0.01)
+
+    def job():
+        "Runs the clients, then stops the server."
+        try:
+            clients = [threading.Thread(target=send_db_requests,
+                                        args=(address, index, num_requests / num_connections))
+                       for index in xrange(num_connections)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(directory)
+        return 2 * num_requests
+    return job
+
+
+WORKLOADS = OrderedDict([
+    ('sudoku 9x9 hard', (sudoku_puzzles, 'puzzles')),
+    ('sudoku 16x16 60% blank', (lambda: sudoku_blanked(4, 0.6), 'puzzles')),
+    ('sudoku 25x25 40% blank',
+     (lambda: sudoku_blanked(5, 0.4, NUM_LARGE_SUDOKU_PUZZLES), 'puzzles')),
+    ('clickomania 12x20 best-first', (lambda: clickomania_board('best-first'), 'boards')),
+    ('clickomania 12x20 beam', (lambda: clickomania_board('beam'), 'boards')),
+    ('clickomania random best-first', (lambda: clickomania_boards('best-first'), 'boards')),
+    ('clickomania child groups', (lambda: clickomania_child_groups(False), 'grids')),
+    ('clickomania incremental groups', (lambda: clickomania_child_groups(True), 'grids')),
+    ('clickomania server', (clickomania_server, 'moves')),
+    ('permutations', (lambda: permutation_words(permutations), 'permutations')),
+    ('permutations_knuth', (lambda: permutation_words(permutations_knuth), 'permutations')),
+    ('permutations_knuth views', (lambda: permutation_kernel('views'), 'permutations')),
+    ('permutations_knuth records', (lambda: permutation_kernel('records'), 'permutations')),
+    ('simple_db', (lambda: db_commands(simple_db.SimpleDb), 'commands')),
+    ('simple_db approximate', (lambda: db_commands(simple_db.ApproximateSimpleDb), 'commands')),
+    ('simple_db transactions', (db_transactions, 'commands')),
+    ('simple_db durable', (db_durable, 'keys')),
+    ('simple_db queries', (db_queries, 'queries')),
+    ('simple_db skewed', (lambda: db_skewed_sets(simple_db.SimpleDb), 'commands')),
+    ('simple_db approximate skewed',
+     (lambda: db_skewed_sets(simple_db.ApproximateSimpleDb), 'commands')),
+    ('simple_db server', (db_server, 'commands'))
+])
+
+
+def run_workload(name, profile=False):
+    """
+        Returns a dict of results for the named workload (set up after seeding random with SEED):
+        seconds, units per second, peak memory (the process's maximum resident set size) and, if
+        profile is set, the top PROFILE_LINES functions by cumulative time.
+    """
+    make_job, unit = WORKLOADS[name]
+    random.seed(SEED)
+    job = make_job()
+    profiler = cProfile.Profile() if profile else None
+    start = time.time()
+    num_units = job() if profiler is None else profiler.runcall(job)
+    seconds = time.time() - start
+    results = {'name': name, 'seconds': seconds, 'unit': unit, 'count': num_units,
+               'per_second': num_units / seconds if seconds else None}
+    results['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if profiler is not None:
+        stream = StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        results['profile'] = stream.getvalue()
+    return results
+
+
+def run_workloads(names, profile=False):
+    "Yields results for each named workload, each run in a fresh process so memory is its own."
+    for name in names:
+        pool = Pool(1)
+        try:
+            yield pool.apply(run_workload, (name, profile))
+        finally:
+            pool.terminate()
+
+
+def compare(results, baseline):
+    "Writes each workload's throughput and memory relative to baseline (earlier results) to stderr."
+    baseline = dict((result['name'], result) for result in baseline['results'])
+    for result in results['results']:
+        previous = baseline.get(result['name'])
+        if previous is not None and previous['per_second'] and previous['peak_memory_kb']:
+            sys.stderr.write('%-30s %6.2fx throughput %6.2fx memory\n'
+                             % (result['name'], result['per_second'] / previous['per_second'],
+                                float(result['peak_memory_kb']) / previous['peak_memory_kb']))
+
+
+def run():
+    """
+        Runs the workloads named as arguments (all of them by default), writing JSON results to
+        stdout (or with --output FILE, to FILE) and a line per workload to stderr. --profile adds
+        cProfile output. With --compare FILE, also writes throughput and memory relative to the
+        results in FILE.
+    """
+    arguments = sys.argv[1:]
+    options = {'--profile': '--profile' in arguments}
+    if options['--profile']:
+        arguments.remove('--profile')
+    for option in ('--output', '--compare'):
+        options[option] = None
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index:index + 2]
+    names = arguments or list(WORKLOADS)
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        sys.stderr.write('unknown workloads: %s\navailable: %s\n'
+                         % (', '.join(unknown), ', '.join(WORKLOADS)))
+        return
+    results = {'python': sys.version.split()[0], 'seed': SEED, 'results': []}
+    for result in run_workloads(names, options['--profile']):
+        sys.stderr.write('%-30s %8.2f seconds %12.1f %s/second %8d KB\n'
+                         % (result['name'], result['seconds'], result['per_second'],
+                            result['unit'], result['peak_memory_kb']))
+        results['results'].append(result)
+    if options['--output'] is None:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        with open(options['--output'], 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    if options['--compare'] is not None:
+        with open(options['--compare']) as infile:
+            compare(results, json.load(infile))
+
+
+if __name__ == '__main__':
+    run()
@@ -2,16 +2,43 @@
 
 "Solves a Click-o-mania (Collapse) puzzle if a solution exists"
 
-from collections import namedtuple
-from itertools import ifilter
-from heapq import heappush, heappop
-import pickle
+from array import array
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from heapq import heappush, heappop, nsmallest
+from multiprocessing import Event, Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+import json
+import os
+import resource
+import SocketServer
+import sqlite3
+import sys
+import threading
+import time
 
 COLORS = '-ROYGBIV'
 COLOR_TO_INDEX_MAPPING = {v: i for i, v in enumerate(COLORS)}
 BITS_PER_COLOR = (len(COLORS) - 1).bit_length()
 BLANK_GRID_BITS = BLANK_COLUMN_BITS = 0
 BLANK_CELL = COLOR_TO_INDEX_MAPPING['-']
+GRID_MASKS = {}
+MOVES_CACHE_FILE = 'jkj_moves_cache.db'
+MOVES_CACHE_SIZE = 100000
+CACHE_SYNC_SECONDS = 30.0
+CANONICAL_SEARCH_KEYS = False
+BEAM_WIDTH = 100
+SEARCH_SECONDS = 1.0
+HEAP_SAMPLE_INTERVAL = 256
+PROFILED_FUNCTIONS = ('get_incremental_moves', 'get_group_masks', 'get_groups', 'remove_group',
+                      'collapse_mask', 'collapse_columns', 'collapse_grid', 'get_state_key')
+PARALLEL_FILTER_BITS = (1 << 27) - 39
+PARALLEL_FILTER_HASHES = 4
+PARALLEL_SUBPROBLEMS_PER_PROCESS = 4
+PARALLEL_CANCEL_CHECK_INTERVAL = 64
+PARALLEL_NODE_BUDGET = 1 << 10
+PARALLEL_BUDGET_GROWTH = 4
+PARALLEL_WORKER = {}
 
 
 class Grid(namedtuple('GridBase', 'num_rows num_columns num_colors bits')):
@@ -23,6 +50,153 @@ class Grid(namedtuple('GridBase', 'num_rows num_columns num_colors bits')):
         return super(Grid, self)._replace(**kwds)
 
 
+class ColumnGrid(namedtuple('ColumnGridBase', 'num_rows num_columns num_colors columns')):
+
+    """
+        Stores data about a Click-o-mania grid as a tuple of columns, each packed like a column of
+        Grid.bits (with blank columns at the end), so a move only rebuilds the columns it touches
+        and the others are shared with the parent grid.
+    """
+
+    __slots__ = ()
+
+    @property
+    def bits(self):
+        "Returns the grid packed into one int, as in Grid."
+        bits = BLANK_GRID_BITS
+        for column in reversed(self.columns):
+            bits = (bits << (self.num_rows * BITS_PER_COLOR)) | column
+        return bits
+
+    def replace(self, **kwds):
+        "Wrapper for _replace method (bits, if given, is split into columns)."
+        if 'bits' in kwds:
+            bits = kwds.pop('bits')
+            bits_per_column = self.num_rows * BITS_PER_COLOR
+            column_mask = (1 << bits_per_column) - 1
+            kwds['columns'] = tuple((bits >> (y_coord * bits_per_column)) & column_mask
+                                    for y_coord in xrange(self.num_columns))
+        return super(ColumnGrid, self)._replace(**kwds)
+
+    # Searches break ties between equally good states by comparing grids, so ColumnGrids order
+    # like Grids (by bits, which compares the last column first) to make the same moves.
+
+    def __lt__(self, other):
+        "Returns True if self orders before other (as Grids with the same bits would)."
+        return self._get_order_key() < other._get_order_key()
+
+    def __le__(self, other):
+        "Returns True if self orders before or equal to other."
+        return self._get_order_key() <= other._get_order_key()
+
+    def __gt__(self, other):
+        "Returns True if self orders after other."
+        return self._get_order_key() > other._get_order_key()
+
+    def __ge__(self, other):
+        "Returns True if self orders after or equal to other."
+        return self._get_order_key() >= other._get_order_key()
+
+    def _get_order_key(self):
+        "Returns tuple ordered like Grid's fields (the columns reversed standing in for bits)."
+        return (self.num_rows, self.num_columns, self.num_colors, tuple(reversed(self.columns)))
+
+
+class MovesCache(object):
+
+    """
+        Maps grids (by num_rows, num_columns and canonical colors, see get_canonical_grid) to the
+        x, y coordinates of the next move.
+
+        Keeps at most max_size entries in memory, evicting the least recently used, and if a
+        filename is given, also reads from and writes to an SQLite store there, one (indexed)
+        entry at a time, so opening it doesn't read in the whole store.
+    """
+
+    def __init__(self, filename=None, max_size=MOVES_CACHE_SIZE):
+        "Initialize MovesCache instance, opening (or creating) an SQLite store at filename if any."
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._store = None
+        if filename:
+            # Callers sharing the cache between threads serialize access to it (see run_server).
+            self._store = sqlite3.connect(filename, check_same_thread=False)
+            self._store.execute('CREATE TABLE IF NOT EXISTS moves '
+                                '(grid TEXT PRIMARY KEY, x INTEGER, y INTEGER)')
+        self.hits = self.store_hits = self.misses = 0
+
+    def get(self, grid):
+        "Returns x, y coordinates of the next move for grid, or None if not cached."
+        key = MovesCache._get_key(grid)
+        move = self._entries.pop(key, None)
+        if move is not None:
+            self.hits += 1
+        else:
+            move = None if self._store is None else self._get_stored(key)
+            if move is None:
+                self.misses += 1
+                return None
+            self.store_hits += 1
+        self._remember(key, move)
+        return move
+
+    def put(self, grid, move):
+        "Caches x, y coordinates of the next move for grid."
+        key = MovesCache._get_key(grid)
+        if self._entries.pop(key, None) != move and self._store is not None:
+            self._store.execute('INSERT OR REPLACE INTO moves VALUES (?, ?, ?)',
+                                (MovesCache._get_store_key(key),) + move)
+        self._remember(key, move)
+
+    def update(self, moves):
+        "Caches each grid, move pair in moves (as returned by get_all_moves)."
+        for grid, move in moves:
+            self.put(grid, move)
+
+    def get_stats(self):
+        "Returns dict of lookup counts, hit rate (memory and store hits) and entries in memory."
+        lookups = self.hits + self.store_hits + self.misses
+        return {'hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits + self.store_hits) / lookups if lookups else 0.0,
+                'size': len(self._entries)}
+
+    def sync(self):
+        "Commits the moves put since the last sync to the SQLite store."
+        if self._store is not None:
+            self._store.commit()
+
+    def close(self):
+        "Commits to and closes the SQLite store."
+        if self._store is not None:
+            self._store.commit()
+            self._store.close()
+            self._store = None
+
+    def _get_stored(self, key):
+        "Returns x, y coordinates stored for in-memory key, or None if there are none."
+        row = self._store.execute('SELECT x, y FROM moves WHERE grid = ?',
+                                  (MovesCache._get_store_key(key),)).fetchone()
+        return None if row is None else tuple(row)
+
+    def _remember(self, key, move):
+        "Adds key as the most recently used entry, evicting the least recently used if full."
+        self._entries[key] = move
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _get_key(grid):
+        "Returns in-memory key for grid (by its canonical form, as moves don't depend on colors)."
+        return (grid.num_rows, grid.num_columns, get_canonical_grid(grid)[0].bits)
+
+    @staticmethod
+    def _get_store_key(key):
+        "Returns SQLite key (a string) for in-memory key."
+        return '%d %d %x' % key
+
+
 def xy_to_bit_position(x_coord, y_coord, grid):
     """
         ORRR
@@ -111,128 +285,855 @@ def collapse_grid(group, grid):
     return grid.replace(bits=bits)
 
 
+def get_grid_masks(grid):
+    """
+        Returns masks (cached per board size) with the lowest bit of every cell set: for all cells,
+        for cells not in row 0, and for cells not in the last row.
+    """
+    size = (grid.num_rows, grid.num_columns)
+    if size not in GRID_MASKS:
+        cells = not_first_row = not_last_row = 0
+        for y_coord in xrange(grid.num_columns):
+            for x_coord in xrange(grid.num_rows):
+                cell = 1 << xy_to_bit_position(x_coord, y_coord, grid)
+                cells |= cell
+                not_first_row |= cell if x_coord != 0 else 0
+                not_last_row |= cell if x_coord != grid.num_rows - 1 else 0
+        GRID_MASKS[size] = (cells, not_first_row, not_last_row)
+    return GRID_MASKS[size]
+
+
+def get_color_plane(grid, color, bit_planes):
+    "Returns mask with the lowest bit of every cell of color set (bit_planes from get_bit_planes)."
+    cells = get_grid_masks(grid)[0]
+    plane = cells
+    for index, bit_plane in enumerate(bit_planes):
+        plane &= bit_plane if (color >> index) & 1 else cells ^ bit_plane
+    return plane
+
+
+def get_bit_planes(grid):
+    "Returns, for each bit of a cell's color, a mask of the cells that have that bit set."
+    cells = get_grid_masks(grid)[0]
+    bits = grid.bits
+    return [(bits >> index) & cells for index in xrange(BITS_PER_COLOR)]
+
+
+def get_occupied_mask(grid):
+    "Returns mask with the lowest bit of every non-blank cell set."
+    return reduce(lambda occupied, bit_plane: occupied | bit_plane, get_bit_planes(grid))
+
+
+def count_cells(grid):
+    "Returns number of non-blank cells."
+    return bin(get_occupied_mask(grid)).count('1')
+
+
+def get_canonical_grid(grid):
+    """
+        Returns grid with its colors relabeled 1, 2, ... in order of first appearance (in bit
+        order), and a list mapping each new color to the original one, so boards that only differ
+        by a permutation of colors share a canonical grid.
+    """
+    grid_bits = grid.bits
+    bit_planes = get_bit_planes(grid)
+    remaining = reduce(lambda occupied, bit_plane: occupied | bit_plane, bit_planes)
+    bits = BLANK_GRID_BITS
+    colors = [BLANK_CELL]
+    while remaining:
+        color = (grid_bits >> ((remaining & -remaining).bit_length() - 1)) & get_one_cell_mask()
+        plane = get_color_plane(grid, color, bit_planes)
+        remaining ^= plane
+        bits |= plane * len(colors)
+        colors.append(color)
+    return grid.replace(bits=bits), colors
+
+
+def get_state_key(grid):
+    """
+        Returns key for grid in search visited sets: a hash of its bits, or of its canonical bits
+        (see get_canonical_grid) if CANONICAL_SEARCH_KEYS is set. ColumnGrids are keyed by bits
+        too (rather than by their columns, whose tuple hashes collide far more often), so both
+        backends skip the same states.
+    """
+    if CANONICAL_SEARCH_KEYS:
+        return hash(get_canonical_grid(grid)[0].bits)
+    return hash(grid.bits)
+
+
+def get_connected(plane, grid):
+    "Returns mask of the cells in plane that have a (non-diagonal) neighbor in plane."
+    _, not_first_row, not_last_row = get_grid_masks(grid)
+    column_shift = get_bits_per_column(grid)
+    return plane & (((plane >> BITS_PER_COLOR) & not_last_row)
+                    | ((plane << BITS_PER_COLOR) & not_first_row)
+                    | (plane >> column_shift)
+                    | (plane << column_shift))
+
+
+def flood_fill(seed, plane, grid):
+    "Returns mask of the cells in plane connected (non-diagonally) to the cells in seed."
+    _, not_first_row, not_last_row = get_grid_masks(grid)
+    column_shift = get_bits_per_column(grid)
+    region = seed
+    while True:
+        grown = (region
+                 | ((region >> BITS_PER_COLOR) & not_last_row)
+                 | ((region << BITS_PER_COLOR) & not_first_row)
+                 | (region >> column_shift)
+                 | (region << column_shift)) & plane
+        if grown == region:
+            return region
+        region = grown
+
+
+def get_mask_cells(mask, grid):
+    "Returns x, y coordinates of the cells whose lowest bit is set in mask, in bit order."
+    cells = []
+    while mask:
+        lowest = mask & -mask
+        mask ^= lowest
+        y_coord, x_coord = divmod((lowest.bit_length() - 1) / BITS_PER_COLOR, grid.num_rows)
+        cells.append((x_coord, y_coord))
+    return cells
+
+
+def get_group_masks(grid, known_masks=None, first_changed_column=0):
+    """
+        Get masks (see get_mask_cells) of all groups of two or more (non-diagonally) connected
+        cells, flood filling one bit plane per color.
+
+        For incremental use, known_masks are the group masks of a grid that only differs from grid
+        in columns first_changed_column and up. Known groups that stay clear of the column before
+        those are kept as they are, and only the remaining cells are flood filled.
+    """
+    bit_planes = get_bit_planes(grid)
+    remaining = get_grid_masks(grid)[0]
+    masks = []
+    if known_masks is not None and first_changed_column > 1:
+        unchanged = (1 << ((first_changed_column - 1) * get_bits_per_column(grid))) - 1
+        masks = [mask for mask in known_masks if mask <= unchanged]
+        remaining &= ~unchanged
+    for color in xrange(1, len(COLORS)):
+        plane = get_color_plane(grid, color, bit_planes)
+        if not plane & remaining:
+            continue
+        connected = get_connected(plane, grid)
+        seeds = connected & remaining
+        while seeds:
+            region = flood_fill(seeds & -seeds, connected, grid)
+            seeds &= ~region
+            masks.append(region)
+    return masks
+
+
 def get_groups(grid):
     "Get all groups of (non-diagonally) connected cells"
-    groups = []
-    grouped = {}
-    one_cell_mask = get_one_cell_mask()
+    masks = get_group_masks(grid)
+    singles = get_occupied_mask(grid)
+    for mask in masks:
+        singles ^= mask
+    return ([get_mask_cells(mask, grid) for mask in masks]
+            + [[cell] for cell in get_mask_cells(singles, grid)])
+
+
+def get_first_changed_column(mask, grid):
+    "Returns the lowest column that collapsing the group in mask changes."
+    return (mask & -mask).bit_length() / get_bits_per_column(grid)
+
+
+def clear_mask(mask, grid):
+    "Sets cells in mask to blank"
+    return grid.replace(bits=grid.bits & ~(mask * get_one_cell_mask()))
+
+
+def collapse_mask(mask, grid):
+    "Removes blank columns touched by the group in mask and compacts its other columns."
+    column_mask = get_one_column_mask(grid)
+    bits_per_column = get_bits_per_column(grid)
+    column_positions = []
+    while mask:
+        column_position = ((mask & -mask).bit_length() - 1) / bits_per_column * bits_per_column
+        column_positions.append((column_position, (mask >> column_position) & column_mask))
+        mask &= ~(column_mask << column_position)
     bits = grid.bits
-    color_appears = [0] * len(COLORS)
-    for y_coord in xrange(grid.num_columns):
-        for x_coord in xrange(grid.num_rows):
-            color = bits & one_cell_mask
-            bits >>= BITS_PER_COLOR
-            if color != BLANK_CELL:
-                color_appears[color] += 1
-                group = None
-                for position in [(x_coord, y_coord - 1, color),
-                                 (x_coord - 1, y_coord, color),
-                                 (x_coord + 1, y_coord, color),
-                                 (x_coord, y_coord + 1, color)]:
-                    if position in grouped and grouped[position] != group:
-                        if group is None:
-                            group = grouped[position]
-                        else:
-                            other = grouped[position]
-                            groups[group] += groups[other]
-                            for ox_coord, oy_coord in groups[other]:
-                                grouped[(ox_coord, oy_coord, color)] = group
-                            groups[other] = None
-                if group is None:
-                    group = len(groups)
-                    groups += [[]]
-                groups[group] += [(x_coord, y_coord)]
-                grouped[(x_coord, y_coord, color)] = group
-    return ifilter(None, groups)
-
-
-def get_incremental_moves(grid):
-    "Get all possible collapses (gives one coordinate per collapsed group)"
-    return [(len(group), group[0][0], group[0][1], collapse_grid(group, clear_cells(group, grid)))
-            for group in get_groups(grid)
-            if len(group) > 1]
-
-
-def get_next_move(grid):
-    "Returns the x, y coordinates of a cell in the group to collapse."
-    try:
-        return get_next_move.moves_cache[grid]
-    except AttributeError:
-        get_next_move.moves_cache = {}
-    except KeyError:
-        pass
-    get_next_move.moves_cache.update(get_all_moves(grid))
-    return get_next_move.moves_cache[grid]
+    for column_position, cleared in reversed(column_positions):
+        column = (bits >> column_position) & column_mask
+        if column == BLANK_COLUMN_BITS:
+            bits = delete_bit_range(bits, bits_per_column, column_position)
+        else:
+            while cleared:
+                position = (cleared & -cleared).bit_length() - 1
+                cleared &= cleared - 1
+                column = delete_bit_range(column, BITS_PER_COLOR, position) << BITS_PER_COLOR
+                column |= BLANK_CELL
+            bits = swap_bit_range(bits, column, bits_per_column, column_position)
+    return grid.replace(bits=bits)
 
 
-def get_all_moves(grid):
-    "Returns a list of grid states and the x, y coordinates of the group to collapse."
-    todo = []
-    tried = {grid}
+def collapse_columns(mask, grid):
+    "Returns ColumnGrid grid after clearing and collapsing the group in mask (see collapse_mask)."
+    column_mask = get_one_column_mask(grid)
+    bits_per_column = get_bits_per_column(grid)
+    columns = list(grid.columns)
+    blank_columns = []
+    while mask:
+        y_coord = ((mask & -mask).bit_length() - 1) / bits_per_column
+        cleared = (mask >> (y_coord * bits_per_column)) & column_mask
+        mask ^= cleared << (y_coord * bits_per_column)
+        column = columns[y_coord] & ~(cleared * get_one_cell_mask())
+        if column == BLANK_COLUMN_BITS:
+            blank_columns.append(y_coord)
+        while cleared:
+            position = (cleared & -cleared).bit_length() - 1
+            cleared &= cleared - 1
+            column = delete_bit_range(column, BITS_PER_COLOR, position) << BITS_PER_COLOR
+            column |= BLANK_CELL
+        columns[y_coord] = column
+    for y_coord in reversed(blank_columns):
+        del columns[y_coord]
+    columns.extend([BLANK_COLUMN_BITS] * len(blank_columns))
+    return grid.replace(columns=tuple(columns))
+
+
+def remove_group(mask, grid):
+    "Returns grid after clearing and collapsing the group in mask."
+    if isinstance(grid, ColumnGrid):
+        return collapse_columns(mask, grid)
+    return collapse_mask(mask, clear_mask(mask, grid))
+
+
+def get_child_group_masks(masks, mask, child_grid):
+    "Returns group masks of child_grid (a grid with masks after collapsing mask), incrementally."
+    return get_group_masks(child_grid, masks, get_first_changed_column(mask, child_grid))
+
+
+def get_incremental_moves(grid, known=None):
+    """
+        Get all possible collapses (gives one coordinate per collapsed group, and the group masks
+        and mask of grid that the new grid came from). Given those as known, finds grid's groups
+        incrementally (see get_child_group_masks).
+    """
+    masks = get_group_masks(grid) if known is None else get_child_group_masks(known[0], known[1],
+                                                                                grid)
     moves = []
-    for num_removed, x_coord, y_coord, new_grid in get_incremental_moves(grid):
-        heappush(todo, (-num_removed, new_grid, [(grid, (x_coord, y_coord)), (new_grid, (0, 0))]))
-        tried |= {new_grid}
+    for mask in masks:
+        x_coord, y_coord = get_mask_cells(mask & -mask, grid)[0]
+        moves.append((bin(mask).count('1'), x_coord, y_coord, remove_group(mask, grid),
+                      (masks, mask)))
+    return moves
+
+
+def make_move(grid, x_coord, y_coord):
+    "Returns grid after collapsing the group containing cell x_coord, y_coord."
+    for group in get_groups(grid):
+        if (x_coord, y_coord) in group:
+            return collapse_grid(group, clear_cells(group, grid))
+    return grid
+
+
+def replay_moves(grid, coordinates):
+    "Returns list of grid states and x, y coordinates for applying coordinates in order from grid."
+    moves = []
+    for x_coord, y_coord in coordinates:
+        moves.append((grid, (x_coord, y_coord)))
+        grid = make_move(grid, x_coord, y_coord)
+    moves.append((grid, (0, 0)))
+    return moves
+
+
+def get_next_move(grid, moves_cache, strategy='best-first', **options):
+    "Returns the x, y coordinates of a cell in the group to collapse, or None if there are none."
+    move = moves_cache.get(grid)
+    if move is None:
+        moves = get_all_moves(grid, strategy, **options)
+        # The last state's (0, 0) is only a placeholder (it may be a partial answer with moves
+        # left), so it isn't cached.
+        moves_cache.update(moves[:-1])
+        move = moves[0][1] if moves else None
+    return move
+
+
+class SearchTree(object):
+
+    "Search nodes, stored as parent node and x, y coordinates of the move that produced each node."
+
+    ROOT = 0
+
+    def __init__(self, grid):
+        "Initialize SearchTree instance with grid as its root node."
+        self.grid = grid
+        self.parents = array('l', [-1])
+        self.x_coords, self.y_coords = array('h', [0]), array('h', [0])
+
+    def __len__(self):
+        "Returns number of nodes, including the root."
+        return len(self.parents)
+
+    def add(self, parent, x_coord, y_coord):
+        "Adds node for collapsing the group at x_coord, y_coord in parent. Returns new node."
+        self.parents.append(parent)
+        self.x_coords.append(x_coord)
+        self.y_coords.append(y_coord)
+        return len(self.parents) - 1
+
+    def get_path(self, node):
+        "Returns list of x, y coordinates of the moves from the root to node."
+        path = []
+        while node != SearchTree.ROOT:
+            path.append((self.x_coords[node], self.y_coords[node]))
+            node = self.parents[node]
+        path.reverse()
+        return path
+
+    def get_moves(self, node):
+        "Returns list of grid states and x, y coordinates from the root to node (empty for root)."
+        if node == SearchTree.ROOT:
+            return []
+        return replay_moves(self.grid, self.get_path(node))
+
+
+def record_search_stats(stats, start, tree, num_expanded, peak_todo, num_duplicates=0,
+                        heap_sizes=()):
+    """
+        Fills stats dict (if not None) with node counts, duplicates skipped, rates, frontier
+        sizes (peak, and sampled every HEAP_SAMPLE_INTERVAL expansions) and peak memory.
+    """
+    if stats is not None:
+        elapsed = time.time() - start
+        stats.update(nodes_expanded=num_expanded,
+                     nodes_generated=len(tree) - 1,
+                     duplicates=num_duplicates,
+                     nodes_per_second=num_expanded / elapsed if elapsed else 0.0,
+                     peak_heap_size=peak_todo,
+                     heap_sizes=list(heap_sizes),
+                     peak_memory_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     seconds=elapsed)
+
+
+def get_lower_bound(grid):
+    """
+        Returns a lower bound on the number of moves needed to clear grid (one per color left), or
+        None if it can't be cleared (a color with a single cell left can never be collapsed).
+    """
+    bit_planes = get_bit_planes(grid)
+    num_colors = 0
+    for color in xrange(1, len(COLORS)):
+        num_cells = bin(get_color_plane(grid, color, bit_planes)).count('1')
+        if num_cells == 1:
+            return None
+        num_colors += num_cells > 0
+    return num_colors
+
+
+def best_first_search(grid, stats=None):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, searching
+        greedily for the most cells removed so far. If no clearing sequence is found, returns the
+        path to the last state searched.
+
+        Search nodes only keep a parent index and the coordinates of the move that produced them
+        (the path is replayed from grid once the search ends), and tried holds get_state_key
+        hashes (a hash collision can only skip a state, never produce a bad move). If stats is
+        a dict, it is filled as described in record_search_stats.
+    """
+    start = time.time()
+    tree = SearchTree(grid)
+    todo = []
+    tried = {get_state_key(grid)}
+    node = SearchTree.ROOT
+    num_expanded = peak_todo = num_duplicates = 0
+    heap_sizes = []
+    for num_removed, x_coord, y_coord, new_grid, known in get_incremental_moves(grid):
+        heappush(todo, (-num_removed, new_grid, tree.add(SearchTree.ROOT, x_coord, y_coord),
+                        known))
+        tried.add(get_state_key(new_grid))
     while todo:
-        num_removed, _, moves = heappop(todo)
-        current_grid = moves[-1][0]
+        peak_todo = max(peak_todo, len(todo))
+        num_removed, current_grid, node, known = heappop(todo)
         if current_grid.bits == BLANK_GRID_BITS:
             break
-        for new_num_removed, x_coord, y_coord, new_grid in get_incremental_moves(current_grid):
-            if new_grid not in tried:
-                tried |= {new_grid}
-                new_num_removed = num_removed - new_num_removed
-                moves[-1] = (current_grid, (x_coord, y_coord))
-                heappush(todo, (new_num_removed, new_grid, moves + [(new_grid, (0, 0))]))
-    return moves
+        if num_expanded % HEAP_SAMPLE_INTERVAL == 0:
+            heap_sizes.append(len(todo))
+        num_expanded += 1
+        for new_num_removed, x_coord, y_coord, new_grid, new_known in get_incremental_moves(
+                current_grid, known):
+            key = get_state_key(new_grid)
+            if key not in tried:
+                tried.add(key)
+                heappush(todo, (num_removed - new_num_removed, new_grid,
+                                tree.add(node, x_coord, y_coord), new_known))
+            else:
+                num_duplicates += 1
+    record_search_stats(stats, start, tree, num_expanded, peak_todo, num_duplicates, heap_sizes)
+    return tree.get_moves(node)
+
+
+def astar_search(grid, stats=None):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, using A*
+        with get_lower_bound to find a shortest clearing sequence. Unclearable states other than
+        grid are pruned. If grid can't be cleared, returns the path to the state with the fewest
+        cells left.
+    """
+    start = time.time()
+    tree = SearchTree(grid)
+    todo = [(get_lower_bound(grid) or 0, 0, grid, SearchTree.ROOT, None)]
+    depths = {get_state_key(grid): 0}
+    best = (count_cells(grid), 0, SearchTree.ROOT)
+    num_expanded = peak_todo = num_duplicates = 0
+    heap_sizes = []
+    while todo:
+        peak_todo = max(peak_todo, len(todo))
+        _, depth, current_grid, node, known = heappop(todo)
+        depth = -depth
+        if current_grid.bits == BLANK_GRID_BITS:
+            best = (0, depth, node)
+            break
+        if depths[get_state_key(current_grid)] < depth:
+            continue
+        if num_expanded % HEAP_SAMPLE_INTERVAL == 0:
+            heap_sizes.append(len(todo))
+        num_expanded += 1
+        for _, x_coord, y_coord, new_grid, new_known in get_incremental_moves(current_grid,
+                                                                              known):
+            key = get_state_key(new_grid)
+            if depths.get(key, depth + 2) <= depth + 1:
+                num_duplicates += 1
+                continue
+            bound = get_lower_bound(new_grid)
+            num_cells = count_cells(new_grid)
+            if bound is None and num_cells >= best[0]:
+                continue
+            child = tree.add(node, x_coord, y_coord)
+            best = min(best, (num_cells, depth + 1, child))
+            if bound is not None:
+                depths[key] = depth + 1
+                heappush(todo, (depth + 1 + bound, -(depth + 1), new_grid, child, new_known))
+    record_search_stats(stats, start, tree, num_expanded, peak_todo, num_duplicates, heap_sizes)
+    return tree.get_moves(best[2])
+
+
+def beam_search(grid, width=BEAM_WIDTH, stats=None):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, keeping
+        only the width states with the fewest cells left at each depth. Unclearable states other
+        than grid are pruned. If no clearing sequence is found, returns the path to the state with
+        the fewest cells left. Its stats heap sizes are the number of children at each depth.
+    """
+    start = time.time()
+    tree = SearchTree(grid)
+    beam = [(grid, SearchTree.ROOT, None)]
+    tried = {get_state_key(grid)}
+    best = (count_cells(grid), 0, SearchTree.ROOT)
+    depth = num_expanded = peak_todo = num_duplicates = 0
+    heap_sizes = []
+    while beam and best[0]:
+        depth += 1
+        children = []
+        for current_grid, node, known in beam:
+            num_expanded += 1
+            for _, x_coord, y_coord, new_grid, new_known in get_incremental_moves(current_grid,
+                                                                                  known):
+                key = get_state_key(new_grid)
+                if key in tried:
+                    num_duplicates += 1
+                    continue
+                tried.add(key)
+                child = tree.add(node, x_coord, y_coord)
+                num_cells = count_cells(new_grid)
+                best = min(best, (num_cells, depth, child))
+                if get_lower_bound(new_grid) is not None:
+                    children.append((num_cells, new_grid, child, new_known))
+        peak_todo = max(peak_todo, len(children))
+        heap_sizes.append(len(children))
+        beam = [(kept_grid, kept_node, kept_known)
+                for _, kept_grid, kept_node, kept_known in nsmallest(width, children)]
+    record_search_stats(stats, start, tree, num_expanded, peak_todo, num_duplicates, heap_sizes)
+    return tree.get_moves(best[2])
+
+
+def anytime_search(grid, seconds=SEARCH_SECONDS, stats=None):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, searching
+        greedily for the most cells removed (pruning unclearable states other than grid) until a
+        clearing sequence is found or seconds have passed. Then returns the path to the state with
+        the fewest cells left found so far.
+    """
+    start = time.time()
+    deadline = start + seconds
+    tree = SearchTree(grid)
+    todo = [(0, grid, SearchTree.ROOT, None)]
+    tried = {get_state_key(grid)}
+    best = (count_cells(grid), 0, SearchTree.ROOT)
+    num_expanded = peak_todo = num_duplicates = 0
+    heap_sizes = []
+    while todo and best[0] and time.time() < deadline:
+        peak_todo = max(peak_todo, len(todo))
+        num_removed, current_grid, node, known = heappop(todo)
+        if num_expanded % HEAP_SAMPLE_INTERVAL == 0:
+            heap_sizes.append(len(todo))
+        num_expanded += 1
+        for new_num_removed, x_coord, y_coord, new_grid, new_known in get_incremental_moves(
+                current_grid, known):
+            key = get_state_key(new_grid)
+            if key in tried:
+                num_duplicates += 1
+                continue
+            tried.add(key)
+            num_cells = count_cells(new_grid)
+            bound = get_lower_bound(new_grid)
+            if bound is None and num_cells >= best[0]:
+                continue
+            child = tree.add(node, x_coord, y_coord)
+            best = min(best, (num_cells, 0, child))
+            if bound is not None:
+                heappush(todo, (num_removed - new_num_removed, new_grid, child, new_known))
+    record_search_stats(stats, start, tree, num_expanded, peak_todo, num_duplicates, heap_sizes)
+    return tree.get_moves(best[2])
+
+
+class VisitedFilter(object):
+
+    """
+        Bloom filter of search states (by get_state_key) in shared memory, setting num_hashes of
+        its num_bits bits per state. The number of bits should be prime: (seed, key) hashes
+        agreeing in their low bits would pick the same bits for every seed otherwise.
+
+        It's lossy: with k hashes, m bits and n states added, a state not added is reported as
+        present with probability about (1 - e ** (-k * n / m)) ** k. With the defaults, that's
+        under one in a million for the first million states, but about one in 230 after ten
+        million. Processes adding at the same time can race on a byte and lose a bit, so an added
+        state can also be reported as absent.
+    """
+
+    def __init__(self, num_bits, num_hashes=PARALLEL_FILTER_HASHES):
+        "Initialize VisitedFilter instance, with no states added."
+        self._num_bits = num_bits
+        self._num_hashes = num_hashes
+        self._bytes = RawArray('B', (num_bits + 7) / 8)
+
+    def add(self, key):
+        "Adds state key."
+        for bit in self._get_bits(key):
+            self._bytes[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        "Returns True if state key has (probably) been added."
+        return all(self._bytes[bit >> 3] & (1 << (bit & 7)) for bit in self._get_bits(key))
+
+    def _get_bits(self, key):
+        "Returns the indexes of the bits for state key."
+        return [hash((seed, key)) % self._num_bits for seed in xrange(self._num_hashes)]
+
+
+def init_parallel_worker(visited, cancelled):
+    "Stores the shared visited filter and cancellation event in a parallel_search worker."
+    PARALLEL_WORKER.update(visited=visited, cancelled=cancelled)
 
 
-def read_moves_cache_from_file(filename):
-    "Reads moves_cache from file if file exists."
+def search_subtree(subproblem):
+    """
+        Runs greedy best-first search in a parallel_search worker from subproblem's grid (reached
+        from the root by the x, y coordinates in its path), expanding at most budget states.
+        States are skipped if they're in the shared VisitedFilter, and if the subtree is exhausted
+        without clearing the grid, every state in it is added. The filter is lossy (a state can
+        look added when it isn't), so a clearing sequence through such a state can be missed.
+        Returns (number of cells left, path, index, whether the subtree was exhausted) for the
+        first clearing sequence found, or else for the state with the fewest cells left.
+    """
+    index, grid, root_path, budget = subproblem
+    visited, cancelled = PARALLEL_WORKER['visited'], PARALLEL_WORKER['cancelled']
+    tree = SearchTree(grid)
+    todo = [(0, grid, SearchTree.ROOT, None)]
+    tried = {get_state_key(grid)}
+    best = (count_cells(grid), SearchTree.ROOT)
+    num_expanded = 0
+    while todo and best[0] and num_expanded < budget:
+        num_expanded += 1
+        if num_expanded % PARALLEL_CANCEL_CHECK_INTERVAL == 0 and cancelled.is_set():
+            break
+        num_removed, current_grid, node, known = heappop(todo)
+        for new_num_removed, x_coord, y_coord, new_grid, new_known in get_incremental_moves(
+                current_grid, known):
+            key = get_state_key(new_grid)
+            if key in tried or key in visited:
+                continue
+            tried.add(key)
+            child = tree.add(node, x_coord, y_coord)
+            best = min(best, (count_cells(new_grid), child))
+            heappush(todo, (num_removed - new_num_removed, new_grid, child, new_known))
+    if not todo:
+        for key in tried:
+            visited.add(key)
+    return best[0], root_path + tree.get_path(best[1]), index, not todo
+
+
+def parallel_search(grid, processes=None, filter_bits=PARALLEL_FILTER_BITS, stats=None):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, splitting
+        the states a few moves from grid (at least PARALLEL_SUBPROBLEMS_PER_PROCESS per process
+        where possible) across a process pool that runs search_subtree on each. Workers share a
+        VisitedFilter of filter_bits bits holding the states in exhausted subtrees, and the first
+        clearing sequence found cancels the rest. Otherwise returns the path to the state with
+        the fewest cells left.
+
+        Subtrees are searched in rounds, each with PARALLEL_BUDGET_GROWTH times the node budget
+        of the last (starting at PARALLEL_NODE_BUDGET), so that one large subtree can't hold up an
+        easy clear in another. Exhausted subtrees are dropped after each round.
+    """
+    start = time.time()
+    processes = processes or cpu_count()
+    visited = VisitedFilter(filter_bits)
+    frontier = [(grid, [])]
+    best = (count_cells(grid), [])
+    tried = {get_state_key(grid)}
+    while 0 < len(frontier) < processes * PARALLEL_SUBPROBLEMS_PER_PROCESS and best[0]:
+        children = []
+        for current_grid, path in frontier:
+            moves = get_incremental_moves(current_grid)
+            if not moves:
+                children.append((current_grid, path))
+            for _, x_coord, y_coord, new_grid, _ in moves:
+                key = get_state_key(new_grid)
+                if key not in tried:
+                    tried.add(key)
+                    children.append((new_grid, path + [(x_coord, y_coord)]))
+                    best = min(best, (count_cells(new_grid), path + [(x_coord, y_coord)]))
+        if len(children) == len(frontier):
+            break
+        frontier = sorted(children, key=lambda (new_grid, path): count_cells(new_grid))
+    num_subproblems = len(frontier)
+    cancelled = Event()
+    pool = Pool(processes, init_parallel_worker, (visited, cancelled))
+    budget = PARALLEL_NODE_BUDGET
+    num_rounds = 0
     try:
-        with open(filename, 'rb') as infile:
-            get_next_move.moves_cache = pickle.load(infile)
-    except IOError:
-        return
-    except EOFError:
-        return
+        while frontier and best[0]:
+            num_rounds += 1
+            subproblems = [(index, new_grid, path, budget)
+                           for index, (new_grid, path) in enumerate(frontier)]
+            unfinished = {}
+            for num_cells, path, index, exhausted in pool.imap_unordered(search_subtree,
+                                                                         subproblems):
+                best = min(best, (num_cells, path))
+                if not best[0]:
+                    cancelled.set()
+                    break
+                if not exhausted:
+                    unfinished[index] = frontier[index]
+            frontier = [unfinished[index] for index in sorted(unfinished)]
+            budget *= PARALLEL_BUDGET_GROWTH
+    finally:
+        pool.terminate()
+    if stats is not None:
+        stats.update(subproblems=num_subproblems, rounds=num_rounds,
+                     processes=processes, seconds=time.time() - start)
+    return replay_moves(grid, best[1]) if best[1] else []
+
+
+SEARCH_STRATEGIES = {
+    'best-first': best_first_search,
+    'astar':      astar_search,
+    'beam':       beam_search,
+    'anytime':    anytime_search,
+    'parallel':   parallel_search
+}
 
 
-def save_moves_cache_to_file(filename):
-    "Saves moves_cache to file to avoid recomputation across calls. Always creates a file."
+@contextmanager
+def profiled(stats, names=PROFILED_FUNCTIONS):
+    """
+        Counts calls and (inclusive) seconds spent in each of the module functions in names into
+        stats['profile'] while active, by swapping in timing wrappers (so there is no cost when
+        not profiling).
+    """
+    functions = dict((name, globals()[name]) for name in names)
+    profile = stats.setdefault('profile', {})
+
+    def time_calls(name, function):
+        "Returns wrapper around function that adds to profile[name]."
+        counts = profile.setdefault(name, {'calls': 0, 'seconds': 0.0})
+
+        def wrapper(*args, **kwds):
+            "Calls function, adding the call and its time to profile[name]."
+            start = time.time()
+            try:
+                return function(*args, **kwds)
+            finally:
+                counts['calls'] += 1
+                counts['seconds'] += time.time() - start
+        return wrapper
+
+    globals().update((name, time_calls(name, function)) for name, function in functions.items())
     try:
-        with open(filename, 'wb') as outfile:
-            pickle.dump(get_next_move.moves_cache, outfile, -1)
-    except AttributeError:
-        return
+        yield stats
+    finally:
+        globals().update(functions)
 
 
-def run():
-    "Reads in grid then returns x, y coordinate for next cell to collapse "
-    num_rows, num_columns, num_colors = [int(value) for value in raw_input().strip().split()]
+def get_all_moves(grid, strategy='best-first', stats=None, profile=False, **options):
+    """
+        Returns a list of grid states and the x, y coordinates of the group to collapse, found by
+        the named strategy in SEARCH_STRATEGIES (options are passed on to it). If profile is set,
+        stats (a dict, which must then be given) also gets call counts and times for group
+        finding and collapsing (see profiled).
+    """
+    search = SEARCH_STRATEGIES[strategy]
+    if profile and stats is None:
+        raise ValueError('profile needs a stats dict to fill')
+    if not profile:
+        return search(grid, stats=stats, **options)
+    with profiled(stats):
+        return search(grid, stats=stats, **options)
+
+
+def format_stats(stats):
+    "Returns stats (as filled by get_all_moves) as JSON."
+    return json.dumps(stats, sort_keys=True)
+
+
+def read_grid(read_line=raw_input, backend=Grid):
+    """
+        Reads in grid (a num_rows num_columns num_colors line, then a line per row) with read_line,
+        as a backend (Grid or ColumnGrid) instance. All the rows are read before any is parsed, so
+        a malformed grid (raising ValueError, KeyError or IndexError) doesn't leave rows unread.
+        Both backends give the same moves, but ColumnGrid searches more slowly, so it's not the
+        default for any size of grid.
+    """
+    num_rows, num_columns, num_colors = [int(value) for value in read_line().strip().split()]
     bits = 0
     grid = Grid(num_rows, num_columns, num_colors, bits)
-    for x_coord in xrange(num_rows):
-        row = raw_input().strip()
+    rows = [read_line().strip() for _ in xrange(num_rows)]
+    for x_coord, row in enumerate(rows):
         for y_coord in xrange(num_columns):
             position = xy_to_bit_position(x_coord, y_coord, grid)
             bits |= COLOR_TO_INDEX_MAPPING[row[y_coord]] << position
 
-    grid = grid.replace(bits=bits)
+    return backend(num_rows, num_columns, num_colors, None).replace(bits=bits)
+
 
-    moves_cache_file = 'jkj_moves_cache'
-    read_moves_cache_from_file(moves_cache_file)
+def format_grid(grid):
+    "Returns grid in read_grid's input format."
+    bits = grid.bits
+    lines = ['%d %d %d' % (grid.num_rows, grid.num_columns, grid.num_colors)]
+    for x_coord in xrange(grid.num_rows):
+        lines.append(''.join(COLORS[(bits >> xy_to_bit_position(x_coord, y_coord, grid))
+                                    & get_one_cell_mask()]
+                             for y_coord in xrange(grid.num_columns)))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(infile, outfile, moves_cache, lock):
+    """
+        Reads grids from infile until end of input, writing and flushing a line with the x, y
+        coordinates of the next move to outfile for each (NO MOVE if no group can be collapsed,
+        INVALID GRID if it can't be read). moves_cache is only used while holding lock.
+    """
+    def read_line():
+        "Returns next line of infile, raising EOFError at end of input (like raw_input)."
+        line = infile.readline()
+        if not line:
+            raise EOFError
+        return line
+
+    while True:
+        try:
+            grid = read_grid(read_line)
+        except EOFError:
+            return
+        except (ValueError, KeyError, IndexError):
+            outfile.write('INVALID GRID\n')
+            outfile.flush()
+            continue
+        with lock:
+            move = get_next_move(grid, moves_cache) if get_group_masks(grid) else None
+        outfile.write('NO MOVE\n' if move is None else '%d %d\n' % move)
+        outfile.flush()
+
+
+class MovesRequestHandler(SocketServer.StreamRequestHandler):
+
+    "Answers grids sent over a server connection (see serve)."
+
+    def handle(self):
+        "Serves grids until the client closes the connection."
+        serve(self.rfile, self.wfile, self.server.moves_cache, self.server.lock)
+
+
+def sync_periodically(moves_cache, lock, stopped, seconds=CACHE_SYNC_SECONDS):
+    "Syncs moves_cache to disk every seconds (holding lock) until stopped is set, then once more."
+    while not stopped.wait(seconds):
+        with lock:
+            moves_cache.sync()
+    with lock:
+        moves_cache.sync()
+
+
+def run_server(moves_cache, socket_path=None):
+    """
+        Answers grids from stdin on stdout (see serve) or, if socket_path is given, from any
+        number of clients connecting to a Unix socket there, until interrupted. moves_cache stays
+        in memory throughout and is synced to disk every CACHE_SYNC_SECONDS.
+    """
+    lock = threading.Lock()
+    stopped = threading.Event()
+    syncer = threading.Thread(target=sync_periodically, args=(moves_cache, lock, stopped))
+    syncer.daemon = True
+    syncer.start()
+    try:
+        if socket_path is None:
+            serve(sys.stdin, sys.stdout, moves_cache, lock)
+        else:
+            if os.path.exists(socket_path):
+                # Left over from an earlier server that died before it could remove it.
+                os.remove(socket_path)
+            server = SocketServer.ThreadingUnixStreamServer(socket_path, MovesRequestHandler)
+            server.daemon_threads = True
+            server.moves_cache, server.lock = moves_cache, lock
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                os.remove(socket_path)
+    finally:
+        stopped.set()
+        syncer.join()
+
+
+def run():
+    """
+        Reads in grid then prints x, y coordinate for next cell to collapse, or NO MOVE if there
+        are none (with --profile, also writes search and moves cache stats as JSON to stderr, so a
+        cached move shows up as a cache hit with no search stats), or with --serve [SOCKET_PATH],
+        keeps answering grids (see run_server).
+    """
+    moves_cache = MovesCache(MOVES_CACHE_FILE)
+    try:
+        if sys.argv[1:2] == ['--serve']:
+            run_server(moves_cache, sys.argv[2] if len(sys.argv) > 2 else None)
+        else:
+            profile = sys.argv[1:2] == ['--profile']
+            stats = {}
+            move = get_next_move(read_grid(), moves_cache, stats=stats, profile=profile)
+            print 'NO MOVE' if move is None else '%d %d' % move
+            if profile:
+                stats['moves_cache'] = moves_cache.get_stats()
+                sys.stderr.write(format_stats(stats) + '\n')
+    finally:
+        moves_cache.close()
 
-    x_coord, y_coord = get_next_move(grid)
-    print x_coord, y_coord
 
-    save_moves_cache_to_file(moves_cache_file)
+if __name__ == '__main__':
+    run()
 
 
 """
 # Tests
 
-# Change run def to: def run(raw_input):, then run
+# Use fake_input() in place of raw_input, e.g. grid = read_grid(fake_input())
 
 def show_grid(grid):
     "Graphical representation of grid"
@@ -265,5 +1166,5 @@ def fake_input():
 
     return lambda: next(data)
 
-run(fake_input())
+print get_next_move(read_grid(fake_input()), MovesCache())
 """
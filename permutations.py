@@ -1,12 +1,19 @@
 "String permutation generator to solve the CodeEval challenge."
 
+from itertools import islice
+from math import factorial
+from multiprocessing import Pool, cpu_count
 import sys
 
+OUTPUT_CHUNK_SIZE = 1 << 16
+PARALLEL_SLICE_SIZE = 1 << 20
+PARALLEL_SLICES_PER_PROCESS = 2
 
-def permutations(string):
-    "Yields all non-repeating string-length permutations of a given string."
+
+def permutations(string, prefix=''):
+    "Yields all non-repeating string-length permutations of a given string (after prefix)."
     string = ''.join(sorted(string))
-    todo = [(string[i], string[:i] + string[i + 1:])
+    todo = [(prefix + string[i], string[:i] + string[i + 1:])
             for i in reversed(xrange(len(string)))]
     append = todo.append
     pop = todo.pop
@@ -20,5 +27,67 @@ def permutations(string):
                 append((permutation + remaining[i], remaining[:i] + remaining[i + 1:]))
 
 
-sys.stdout.writelines(','.join(permutations(word.rstrip())) + '\n'
-                      for word in open(sys.argv[1], 'r'))
+def write_permutations(outfile, permutations, chunk_size=OUTPUT_CHUNK_SIZE):
+    "Writes permutations to outfile, comma separated, chunk_size permutations at a time."
+    separator = ''
+    for chunk in iter(lambda: list(islice(permutations, chunk_size)), []):
+        outfile.write(separator + ','.join(chunk))
+        separator = ','
+
+
+def get_slices(string, slice_size):
+    """
+        Returns (prefix, remaining) pairs splitting string's permutations into consecutive
+        subtrees of at most slice_size permutations (or single permutations), in order.
+    """
+    slices = [('', ''.join(sorted(string)))]
+    while len(slices[0][1]) > 1 and factorial(len(slices[0][1])) > slice_size:
+        slices = [(prefix + remaining[i], remaining[:i] + remaining[i + 1:])
+                  for prefix, remaining in slices for i in xrange(len(remaining))]
+    return slices
+
+
+def join_slice((prefix, remaining)):
+    "Returns comma-separated permutations of remaining, each after prefix."
+    return ','.join(permutations(remaining, prefix)) if remaining else prefix
+
+
+def write_permutations_parallel(outfile, string, pool, num_processes,
+                                slice_size=PARALLEL_SLICE_SIZE):
+    """
+        Writes permutations of string to outfile, comma separated, splitting them into subtrees
+        of at most slice_size permutations generated by pool's num_processes processes. Only a
+        few subtrees per process are in flight at a time, and they're written in order.
+    """
+    slices = iter(get_slices(string, slice_size))
+    separator = ''
+    for batch in iter(lambda: list(islice(slices, num_processes * PARALLEL_SLICES_PER_PROCESS)),
+                      []):
+        for permutations_slice in pool.imap(join_slice, batch):
+            outfile.write(separator + permutations_slice)
+            separator = ','
+
+
+def run():
+    """
+        Writes the permutations of each word in the file given as the first argument, one line
+        per word. With --processes N, words with many permutations are split between N processes.
+    """
+    arguments = sys.argv[1:]
+    pool = None
+    if '--processes' in arguments:
+        index = arguments.index('--processes')
+        num_processes = int(arguments[index + 1]) or cpu_count()
+        pool = Pool(num_processes)
+        del arguments[index:index + 2]
+    for word in open(arguments[0], 'r'):
+        word = word.rstrip()
+        if pool is not None and factorial(len(word)) > PARALLEL_SLICE_SIZE:
+            write_permutations_parallel(sys.stdout, word, pool, num_processes)
+        else:
+            write_permutations(sys.stdout, permutations(word))
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,14 +1,79 @@
 "String permutation generator to solve the CodeEval challenge."
 
+from itertools import islice
+from math import factorial
+from multiprocessing import Pool, cpu_count
 import sys
 
+OUTPUT_CHUNK_SIZE = 1 << 16
+PARALLEL_SLICE_SIZE = 1 << 20
+PARALLEL_SLICES_PER_PROCESS = 2
 
-def permutations(string):
-    "Yields all non-repeating string-length permutations of a given string."
-    string = ''.join(sorted(string))
+
+def count(multiset):
+    "Returns number of non-repeating permutations of multiset (the multinomial coefficient)."
+    num_permutations = factorial(len(multiset))
+    for character in set(multiset):
+        num_permutations //= factorial(multiset.count(character))
+    return num_permutations
+
+
+def rank(string):
+    "Returns position of string among the lexicographically ordered permutations of its characters."
+    counts = dict((character, string.count(character)) for character in set(string))
+    # Of the num_permutations permutations of the remaining characters, counts[character] / length
+    # start with character, so each smaller character skips that many permutations.
+    num_permutations = count(string)
+    position = 0
+    for length, character in zip(xrange(len(string), 0, -1), string):
+        position += num_permutations * sum(counts[smaller] for smaller in counts
+                                           if smaller < character) // length
+        num_permutations = num_permutations * counts[character] // length
+        counts[character] -= 1
+        if not counts[character]:
+            del counts[character]
+    return position
+
+
+def unrank(multiset, position):
+    "Returns permutation of multiset's characters that's at position in lexicographic order."
+    num_permutations = count(multiset)
+    if not 0 <= position < num_permutations:
+        raise ValueError("position %d out of range for %d permutations" % (position,
+                                                                            num_permutations))
+    counts = dict((character, multiset.count(character)) for character in set(multiset))
+    characters = []
+    for length in xrange(len(multiset), 0, -1):
+        for character in sorted(counts):
+            num_starting_with = num_permutations * counts[character] // length
+            if position < num_starting_with:
+                break
+            position -= num_starting_with
+        characters.append(character)
+        num_permutations = num_starting_with
+        counts[character] -= 1
+        if not counts[character]:
+            del counts[character]
+    return ''.join(characters)
+
+
+def permutations(string, start=0, stop=None):
+    """
+        Yields non-repeating string-length permutations of a given string in lexicographic
+        order, from the start-th (counting from 0) up to but excluding the stop-th (or the last).
+    """
+    num_permutations = count(string)
+    stop = num_permutations if stop is None else min(stop, num_permutations)
+    if start >= stop:
+        return
+    string = unrank(string, start)
     length = len(string)
+    num_remaining = stop - start
     while True:
         yield string
+        num_remaining -= 1
+        if not num_remaining:
+            return
         for index in reversed(xrange(1, length)):
             if string[index] > string[index - 1]:
                 left = index - 1
@@ -27,5 +92,136 @@ def permutations(string):
                   + (string[left + 1:right] + string[left:left + 1] + string[right + 1:])[::-1])
 
 
-sys.stdout.writelines(','.join(permutations(word.rstrip())) + '\n'
-                      for word in open(sys.argv[1], 'r'))
+def next_permutation(permutation):
+    """
+        Steps permutation (a bytearray or array('B')) in place to the next one in lexicographic
+        order, returning False (and leaving it alone) if it's already the last one.
+    """
+    left = len(permutation) - 2
+    while left >= 0 and permutation[left] >= permutation[left + 1]:
+        left -= 1
+    if left < 0:
+        return False
+    right = len(permutation) - 1
+    while permutation[right] <= permutation[left]:
+        right -= 1
+    # Swap left and right characters, then reverse everything after left.
+    permutation[left], permutation[right] = permutation[right], permutation[left]
+    permutation[left + 1:] = permutation[:left:-1]
+    return True
+
+
+def permutation_buffers(string, start=0, stop=None):
+    """
+        Yields the permutations permutations(string, start, stop) would, as a single bytearray
+        that's stepped in place between yields (so copy it to keep a permutation).
+    """
+    num_permutations = count(string)
+    stop = num_permutations if stop is None else min(stop, num_permutations)
+    if start >= stop:
+        return
+    permutation = bytearray(unrank(string, start))
+    num_remaining = stop - start
+    while True:
+        yield permutation
+        num_remaining -= 1
+        if not num_remaining:
+            return
+        next_permutation(permutation)
+
+
+def fill_records(permutation, output, num_records):
+    """
+        Writes num_records permutations into output (a preallocated bytearray) as fixed-width
+        records of a permutation followed by one separator byte (left as it is), starting with
+        permutation and stepping it in place between records. Returns number of records written,
+        which is fewer only if the last permutation was reached.
+    """
+    length = len(permutation)
+    width = length + 1
+    for num_written in xrange(num_records):
+        if num_written and not next_permutation(permutation):
+            return num_written
+        start = num_written * width
+        output[start:start + length] = permutation
+    return num_records
+
+
+def write_permutations(outfile, string, start=0, stop=None, chunk_size=OUTPUT_CHUNK_SIZE):
+    """
+        Writes permutations(string, start, stop) to outfile, comma separated, filling and writing
+        one preallocated buffer of chunk_size records at a time.
+    """
+    num_permutations = count(string)
+    num_remaining = (num_permutations if stop is None else min(stop, num_permutations)) - start
+    if num_remaining <= 0:
+        return
+    permutation = bytearray(unrank(string, start))
+    width = len(permutation) + 1
+    output = bytearray(',' * (width * min(chunk_size, num_remaining)))
+    while True:
+        num_records = fill_records(permutation, output, min(chunk_size, num_remaining))
+        num_remaining -= num_records
+        if not num_remaining:
+            # Leave off the last separator.
+            outfile.write(buffer(output, 0, width * num_records - 1))
+            return
+        outfile.write(buffer(output, 0, width * num_records))
+        next_permutation(permutation)
+
+
+def get_slices(string, slice_size):
+    "Yields (string, start, stop) for consecutive slice_size ranges of string's permutations."
+    num_permutations = count(string)
+    start = 0
+    while start < num_permutations:
+        yield string, start, min(start + slice_size, num_permutations)
+        start += slice_size
+
+
+def join_slice((string, start, stop)):
+    "Returns comma-separated permutations of string from the start-th up to the stop-th."
+    output = bytearray(',' * ((len(string) + 1) * (stop - start)))
+    fill_records(bytearray(unrank(string, start)), output, stop - start)
+    return str(buffer(output, 0, len(output) - 1))
+
+
+def write_permutations_parallel(outfile, string, pool, num_processes,
+                                slice_size=PARALLEL_SLICE_SIZE):
+    """
+        Writes permutations of string to outfile, comma separated, splitting them into slice_size
+        ranges generated by pool's num_processes processes. Only a few slices per process are
+        in flight at a time, and they're written in order.
+    """
+    slices = get_slices(string, slice_size)
+    separator = ''
+    for batch in iter(lambda: list(islice(slices, num_processes * PARALLEL_SLICES_PER_PROCESS)),
+                      []):
+        for permutations_slice in pool.imap(join_slice, batch):
+            outfile.write(separator + permutations_slice)
+            separator = ','
+
+
+def run():
+    """
+        Writes the permutations of each word in the file given as the first argument, one line
+        per word. With --processes N, words with many permutations are split between N processes.
+    """
+    arguments = sys.argv[1:]
+    pool = None
+    if '--processes' in arguments:
+        index = arguments.index('--processes')
+        num_processes = int(arguments[index + 1]) or cpu_count()
+        pool = Pool(num_processes)
+        del arguments[index:index + 2]
+    for word in open(arguments[0], 'r'):
+        word = word.rstrip()
+        if pool is not None and count(word) > PARALLEL_SLICE_SIZE:
+            write_permutations_parallel(sys.stdout, word, pool, num_processes)
+        else:
+            write_permutations(sys.stdout, word)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,19 +1,155 @@
 "Simple in-memory database as a response to the Thumbtack coding challenge."
 
-from collections import OrderedDict
+from bisect import bisect_left
+from itertools import chain, izip
+import asynchat
+import asyncore
+import heapq
+import os
+import signal
+import socket
+import sys
+import time
+
+BULK_CHUNK_SIZE = 1 << 20
+SYNC_EVERY = 1000
+SERVER_SYNC_SECONDS = 1
+SORTED_LIST_BUCKET_SIZE = 1000
+COMPACT_EVERY = 10 ** 6
+SKETCH_WIDTH = 16381
+SKETCH_DEPTH = 4
+NUM_HEAVY_HITTERS = 100
+
+
+class SortedList(object):
+
+    """
+        Sorted list of unique items, stored as a list of sorted buckets of at most twice
+        SORTED_LIST_BUCKET_SIZE items (so adding and removing cost O(sqrt(n)), not O(n)).
+    """
+
+    def __init__(self, items=()):
+        "Initialize SortedList instance with items (which must be sorted and unique)."
+        items = list(items)
+        self._buckets = [items[index:index + SORTED_LIST_BUCKET_SIZE]
+                         for index in xrange(0, len(items), SORTED_LIST_BUCKET_SIZE)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+
+    def add(self, item):
+        "Inserts item, unless it's already present."
+        if not self._buckets:
+            self._buckets, self._maxes = [[item]], [item]
+            return
+        index = min(bisect_left(self._maxes, item), len(self._maxes) - 1)
+        bucket = self._buckets[index]
+        position = bisect_left(bucket, item)
+        if position < len(bucket) and bucket[position] == item:
+            return
+        bucket.insert(position, item)
+        self._maxes[index] = bucket[-1]
+        if len(bucket) > 2 * SORTED_LIST_BUCKET_SIZE:
+            self._buckets[index:index + 1] = [bucket[:SORTED_LIST_BUCKET_SIZE],
+                                              bucket[SORTED_LIST_BUCKET_SIZE:]]
+            self._maxes[index:index + 1] = [bucket[SORTED_LIST_BUCKET_SIZE - 1], bucket[-1]]
+
+    def update(self, items):
+        "Inserts each of items, rebuilding the buckets if there are too many to insert one by one."
+        items = list(items)
+        if len(items) * 16 < sum(len(bucket) for bucket in self._buckets):
+            for item in items:
+                self.add(item)
+        elif items:
+            self.__init__(sorted(set(chain(chain.from_iterable(self._buckets), items))))
+
+    def remove(self, item):
+        "Removes item, if it's present."
+        index = bisect_left(self._maxes, item)
+        if index == len(self._maxes):
+            return
+        bucket = self._buckets[index]
+        position = bisect_left(bucket, item)
+        if bucket[position] != item:
+            return
+        del bucket[position]
+        if bucket:
+            self._maxes[index] = bucket[-1]
+        else:
+            del self._buckets[index], self._maxes[index]
+
+    def __iter__(self):
+        "Yields all items, in order."
+        return chain.from_iterable(self._buckets)
+
+    def irange(self, low, high=None):
+        "Yields items from low up to (and including) high, in order."
+        index = bisect_left(self._maxes, low)
+        position = bisect_left(self._buckets[index], low) if index < len(self._maxes) else 0
+        for bucket in self._buckets[index:]:
+            for item in bucket[position:]:
+                if high is not None and item > high:
+                    return
+                yield item
+            position = 0
+
+    def iprefix(self, prefix):
+        "Yields items that start with prefix, in order."
+        for item in self.irange(prefix):
+            if not item.startswith(prefix):
+                return
+            yield item
+
+
+class CountMinSketch(object):
+
+    """
+        Count-min sketch: depth rows of width counters, each value adding to one counter per row.
+        Estimates never undercount (as long as no value's count goes negative) and overcount by
+        about 2 * total / width at most, with probability 1 - 2 ** -depth. The width should be
+        prime: (row, value) hashes agreeing in their low bits would collide in every row otherwise.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        "Initialize CountMinSketch instance."
+        self._width = width
+        self._rows = [[0] * width for _ in xrange(depth)]
+
+    def add(self, value, amount=1):
+        "Adds amount to value's count."
+        for row, column in self._get_columns(value):
+            row[column] += amount
+
+    def estimate(self, value):
+        "Returns estimated count of value."
+        return min(row[column] for row, column in self._get_columns(value))
+
+    def _get_columns(self, value):
+        "Returns each row paired with value's counter index in it."
+        return [(row, hash((seed, value)) % self._width) for seed, row in enumerate(self._rows)]
 
 
 class SimpleDb(object):
 
-    "Simple in-memory database as a response to the Thumbtack coding challenge."
+    """
+        Simple in-memory database as a response to the Thumbtack coding challenge.
+
+        Changes are applied directly (so reads and counts never look at transactions), and each
+        open transaction keeps an undo log of the values its changes replaced, so rolling back
+        costs time proportional to the changes made in that transaction and committing is O(1)
+        per open transaction. The names holding each value (which also give value counts), the
+        values with each count, and sorted lists of names, values and counts are kept up to date
+        the same way, for NUMEQUALTO, KEYSWITH, RANGE, PREFIX and TOPVALUES queries. Values and
+        counts no names hold any more are dropped.
+    """
 
     def __init__(self):
         "Initialize SimpleDb instance."
         self._db = {}
-        self._value_count = {}
-        self._num_open_transactions = 0
-        self._transactions = {}
-        self._transaction_value_count = {}
+        self._undo_logs = []
+        self._value_names = {}
+        self._count_values = {}
+        self._sorted_names = SortedList()
+        self._sorted_values = SortedList()
+        self._sorted_counts = SortedList()
 
     def put(self, name, value):
         "Inserts/updates value of name in database."
@@ -21,87 +157,558 @@ class SimpleDb(object):
 
     def get(self, name):
         "Returns value of name if it exists in the database, otherwise returns None."
-        if self._is_transaction_open() and name in self._transactions:
-            return self._transactions[name][SimpleDb._get_last_key(self._transactions[name])]
-        elif name in self._db:
-            return self._db[name]
-        else:
-            return None
+        return self._db.get(name)
 
     def count(self, value):
         "Returns number of entries in the database that have the specified value."
-        t_val_cnt = self._transaction_value_count
-        return ((self._value_count[value] if value in self._value_count else 0) +
-                (t_val_cnt[value] if self._is_transaction_open() and value in t_val_cnt else 0))
+        return len(self._value_names.get(value, ()))
 
     def unset(self, name):
         "Removes name from database if it's present."
         self._update_value(name, None)
 
+    def top_values(self, num_values):
+        "Returns up to num_values (value, count) pairs with the highest counts (ties by value)."
+        top = []
+        for negative_count in self._sorted_counts:
+            if len(top) >= num_values:
+                break
+            top.extend((value, -negative_count) for value in
+                       heapq.nsmallest(num_values - len(top), self._count_values[-negative_count]))
+        return top
+
+    def keys_with(self, value):
+        "Returns sorted list of names that have the specified value."
+        return sorted(self._value_names.get(value, ()))
+
+    def keys_in_range(self, low, high):
+        "Returns sorted list of names whose values are between low and high (inclusive)."
+        names = []
+        for value in self._sorted_values.irange(low, high):
+            names.extend(self._value_names[value])
+        return sorted(names)
+
+    def keys_with_prefix(self, prefix):
+        "Returns sorted list of names that start with prefix."
+        return list(self._sorted_names.iprefix(prefix))
+
+    def put_many(self, items):
+        """
+            Inserts/updates each name, value pair in items in order, like put. Outside a
+            transaction, new names are added to the sorted list of names in one go.
+        """
+        if self._is_transaction_open():
+            for name, value in items:
+                self.put(name, value)
+            return
+        db = self._db
+        new_names = []
+        for name, value in items:
+            current_value = db.get(name)
+            if current_value != value:
+                db[name] = value
+                self._update_value_names(name, current_value, value)
+                if current_value is None:
+                    new_names.append(name)
+        self._sorted_names.update(new_names)
+
     def begin(self):
         "Opens transaction block."
-        self._num_open_transactions += 1
+        self._undo_logs.append({})
 
     def rollback(self):
         "Rolls back most recent transaction, returning False if no open transactions."
         if not self._is_transaction_open():
             return False
-        for name in self._transactions.keys():
-            if self._num_open_transactions in self._transactions[name]:
-                value = self._transactions[name].pop(self._num_open_transactions)
-                if not self._transactions[name]:
-                    del self._transactions[name]
-                self._update_num_equal_to(value, self.get(name))
-        self._num_open_transactions -= 1
+        for name, value in self._undo_logs.pop().iteritems():
+            self._set_value(name, value)
         return True
 
     def commit(self):
         "Commits all transactions, returning False if no open transactions."
         if not self._is_transaction_open():
             return False
-        self._num_open_transactions = 0
-        any(self._update_value(name, values[SimpleDb._get_last_key(values)])
-            for name, values in self._transactions.iteritems())
-        self._transactions = {}
-        self._transaction_value_count = {}
+        self._undo_logs = []
         return True
 
-    @staticmethod
-    def _get_last_key(ordered):
-        "Returns key (or value if list, etc) most recently added to ordered."
-        return next(reversed(ordered)) if ordered else None
-
     def _is_transaction_open(self):
         "Returns True if there is currently a pending transaction. Returns False otherwise."
-        return self._num_open_transactions > 0
-
-    def _update_num_equal_to(self, current_value, new_value=None):
-        "Swaps current_value (lowers count by 1) with new_value (add 1). Skips None values."
-        target = (self._transaction_value_count if self._is_transaction_open() else
-                  self._value_count)
-        for amount_to_add, value in [(-1, current_value), (1, new_value)]:
-            if value is not None:
-                target.setdefault(value, 0)
-                target[value] += amount_to_add
+        return bool(self._undo_logs)
 
     def _update_value(self, name, value):
-        "Updates value (adding/editing/deleting) in database."
+        "Updates value (adding/editing/deleting) in database, logging the old value if needed."
         current_value = self.get(name)
         if current_value == value:
             return
         elif self._is_transaction_open():
-            self._transactions.setdefault(name, OrderedDict())
-            self._transactions[name][self._num_open_transactions] = value
-        elif value is None:
-            del self._db[name]
-        else:
+            self._undo_logs[-1].setdefault(name, current_value)
+        self._set_value(name, value)
+
+    def _set_value(self, name, value):
+        "Sets (or deletes, if value is None) value of name, keeping value counts up to date."
+        current_value = self._db.pop(name, None)
+        if value is not None:
             self._db[name] = value
-        self._update_num_equal_to(current_value, value)
+        self._update_indexes(name, current_value, value)
+
+    def _update_indexes(self, name, current_value, new_value):
+        "Moves name from current_value to new_value in the indexes. Skips None values."
+        self._update_value_names(name, current_value, new_value)
+        if current_value is None and new_value is not None:
+            self._sorted_names.add(name)
+        elif current_value is not None and new_value is None:
+            self._sorted_names.remove(name)
+
+    def _update_value_names(self, name, current_value, new_value):
+        "Moves name from the names with current_value to those with new_value. Skips None values."
+        if current_value is not None:
+            names = self._value_names[current_value]
+            names.discard(name)
+            self._update_count(current_value, len(names) + 1, len(names))
+            if not names:
+                del self._value_names[current_value]
+                self._sorted_values.remove(current_value)
+        if new_value is not None:
+            if new_value not in self._value_names:
+                self._value_names[new_value] = set()
+                self._sorted_values.add(new_value)
+            names = self._value_names[new_value]
+            names.add(name)
+            self._update_count(new_value, len(names) - 1, len(names))
+
+    def _update_count(self, value, current_count, new_count):
+        "Moves value from the values with current_count to those with new_count. Skips 0 counts."
+        if current_count:
+            values = self._count_values[current_count]
+            values.discard(value)
+            if not values:
+                del self._count_values[current_count]
+                self._sorted_counts.remove(-current_count)
+        if new_count:
+            if new_count not in self._count_values:
+                self._count_values[new_count] = set()
+                self._sorted_counts.add(-new_count)
+            self._count_values[new_count].add(value)
+
+    def _rebuild_indexes(self):
+        "Rebuilds the indexes from the data (after loading it in bulk)."
+        self._value_names = {}
+        for name, value in self._db.iteritems():
+            self._value_names.setdefault(value, set()).add(name)
+        self._count_values = {}
+        for value, names in self._value_names.iteritems():
+            self._count_values.setdefault(len(names), set()).add(value)
+        self._sorted_names = SortedList(sorted(self._db))
+        self._sorted_values = SortedList(sorted(self._value_names))
+        self._sorted_counts = SortedList(sorted(-count for count in self._count_values))
+
+
+class ApproximateSimpleDb(SimpleDb):
+
+    """
+        SimpleDb whose value statistics take bounded memory: NUMEQUALTO is estimated by a
+        count-min sketch (so it may overcount), and TOPVALUES reports the highest estimates among
+        up to num_heavy_hitters tracked values. KEYSWITH and RANGE scan all data instead.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+                 num_heavy_hitters=NUM_HEAVY_HITTERS):
+        "Initialize ApproximateSimpleDb instance."
+        super(ApproximateSimpleDb, self).__init__()
+        self._sketch = CountMinSketch(width, depth)
+        self._num_heavy_hitters = num_heavy_hitters
+        self._heavy_hitters = {}
+        self._min_heavy_hitter_count = 0
+
+    def count(self, value):
+        "Returns estimated number of entries in the database that have the specified value."
+        return self._sketch.estimate(value)
+
+    def top_values(self, num_values):
+        "Returns up to num_values (value, estimated count) pairs with the highest estimated counts."
+        self._refresh_heavy_hitters()
+        return heapq.nsmallest(num_values, ((value, count) for value, count
+                                            in self._heavy_hitters.iteritems() if count),
+                               key=lambda (value, count): (-count, value))
+
+    def keys_with(self, value):
+        "Returns sorted list of names that have the specified value."
+        return sorted(name for name, current_value in self._db.iteritems()
+                      if current_value == value)
+
+    def keys_in_range(self, low, high):
+        "Returns sorted list of names whose values are between low and high (inclusive)."
+        return sorted(name for name, value in self._db.iteritems() if low <= value <= high)
+
+    def _update_value_names(self, name, current_value, new_value):
+        "Moves a count from current_value to new_value in the sketch. Skips None values."
+        if current_value is not None:
+            self._sketch.add(current_value, -1)
+        if new_value is not None:
+            self._sketch.add(new_value, 1)
+            self._track(new_value)
+
+    def _track(self, value):
+        "Tracks value as a heavy hitter if its estimated count is among the highest."
+        count = self._sketch.estimate(value)
+        if value in self._heavy_hitters or len(self._heavy_hitters) < self._num_heavy_hitters:
+            self._heavy_hitters[value] = count
+        elif count > self._min_heavy_hitter_count:
+            # Tracked counts may have dropped since they were recorded, so refresh them first.
+            self._refresh_heavy_hitters()
+            least = min(self._heavy_hitters, key=self._heavy_hitters.get)
+            if count > self._heavy_hitters[least]:
+                del self._heavy_hitters[least]
+                self._heavy_hitters[value] = count
+            self._min_heavy_hitter_count = min(self._heavy_hitters.itervalues())
+
+    def _refresh_heavy_hitters(self):
+        "Updates the heavy hitters' estimated counts from the sketch."
+        for value in self._heavy_hitters:
+            self._heavy_hitters[value] = self._sketch.estimate(value)
+
+
+class DurableSimpleDb(SimpleDb):
+
+    """
+        SimpleDb that persists committed changes to path + '.log' (a write-ahead log of SET and
+        UNSET commands, each commit's block of them ended by a COMMIT line, flushed on every
+        commit and fsynced every sync_every records), compacting the log into path + '.snapshot'
+        (a name and value per line) every compact_every records. Loads both on startup.
+    """
+
+    def __init__(self, path, sync_every=SYNC_EVERY, compact_every=COMPACT_EVERY):
+        "Initialize DurableSimpleDb instance, recovering the data saved at path."
+        super(DurableSimpleDb, self).__init__()
+        self._log_path = path + '.log'
+        self._snapshot_path = path + '.snapshot'
+        self._sync_every = sync_every
+        self._compact_every = compact_every
+        self._num_unsynced = self._num_logged = 0
+        self._load_snapshot()
+        self._replay_log()
+        self._log = open(self._log_path, 'a')
+
+    def commit(self):
+        "Commits all transactions (logging their changes), returning False if none are open."
+        names = set().union(*self._undo_logs)
+        if not super(DurableSimpleDb, self).commit():
+            return False
+        self._log_values(names)
+        return True
+
+    def put_many(self, items):
+        "Inserts/updates each name, value pair in items in order, logging them if committed."
+        items = list(items)
+        super(DurableSimpleDb, self).put_many(items)
+        if not self._is_transaction_open():
+            self._log_values(name for name, _ in items)
+
+    def sync(self):
+        "Flushes and fsyncs the log."
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._num_unsynced = 0
+
+    def compact(self):
+        "Writes all committed data to the snapshot (atomically), then empties the log."
+        self.sync()
+        committed = self._get_committed()
+        temp_path = self._snapshot_path + '.tmp'
+        with open(temp_path, 'w') as snapshot:
+            snapshot.writelines('%s %s\n' % item for item in committed.iteritems())
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_path, self._snapshot_path)
+        self._log.close()
+        self._log = open(self._log_path, 'w')
+        self._num_logged = 0
+
+    def _get_committed(self):
+        "Returns a dict of the committed names and values (undoing any open transactions)."
+        if not self._is_transaction_open():
+            return self._db
+        committed = dict(self._db)
+        for undo_log in reversed(self._undo_logs):
+            for name, value in undo_log.iteritems():
+                if value is None:
+                    committed.pop(name, None)
+                else:
+                    committed[name] = value
+        return committed
+
+    def close(self):
+        "Syncs and closes the log (uncommitted changes are lost)."
+        self.sync()
+        self._log.close()
+
+    def _update_value(self, name, value):
+        "Updates value in database, logging it if there are no open transactions."
+        super(DurableSimpleDb, self)._update_value(name, value)
+        if not self._is_transaction_open():
+            self._log_values([name])
+
+    def _log_values(self, names):
+        """
+            Appends the current values of names to the log as one block ended by a COMMIT line and
+            flushes it, then syncs or compacts if due.
+        """
+        num_logged = 0
+        for name in names:
+            value = self.get(name)
+            self._log.write('UNSET %s\n' % name if value is None else
+                            'SET %s %s\n' % (name, value))
+            num_logged += 1
+        self._log.write('COMMIT\n')
+        self._log.flush()
+        self._num_unsynced += num_logged
+        self._num_logged += num_logged
+        if self._num_logged >= self._compact_every:
+            self.compact()
+        elif self._num_unsynced >= self._sync_every:
+            self.sync()
+
+    def _load_snapshot(self):
+        "Loads names and values from the snapshot, if any."
+        if not os.path.exists(self._snapshot_path):
+            return
+        with open(self._snapshot_path) as snapshot:
+            items = iter(snapshot.read().split())
+        self._db = dict(izip(items, items))
+        self._rebuild_indexes()
+
+    def _replay_log(self):
+        """
+            Applies each block of SET and UNSET commands in the log ended by a COMMIT line,
+            truncating whatever follows the last one (a torn or uncommitted block).
+        """
+        if not os.path.exists(self._log_path):
+            return
+        length = committed_length = 0
+        items = []
+        with open(self._log_path, 'r+') as log:
+            for line in log:
+                if not line.endswith('\n'):
+                    break
+                length += len(line)
+                command = line.split()
+                if command[0] != 'COMMIT':
+                    items.append((command[1], command[2] if command[0] == 'SET' else None))
+                    continue
+                for name, value in items:
+                    self._set_value(name, value)
+                self._num_logged += len(items)
+                items = []
+                committed_length = length
+            log.truncate(committed_length)
+
+
+class Session(object):
+
+    """
+        A client's view of a shared SimpleDb, with its own transactions: changes made in a
+        transaction are kept in per-level overlays (seen only by this session) and applied to the
+        shared database on commit. Reads see committed data plus the session's own changes.
+    """
+
+    def __init__(self, simple_db):
+        "Initialize Session instance over simple_db."
+        self._simple_db = simple_db
+        self._levels = []
+
+    def put(self, name, value):
+        "Inserts/updates value of name in database."
+        self._update_value(name, value)
+
+    def get(self, name):
+        "Returns value of name if it exists in the database, otherwise returns None."
+        for level in reversed(self._levels):
+            if name in level:
+                return level[name]
+        return self._simple_db.get(name)
+
+    def count(self, value):
+        """
+            Returns number of entries in the database that have the specified value (takes time
+            proportional to the number of names changed in open transactions).
+        """
+        total = self._simple_db.count(value)
+        for name, new_value in self._get_changes().iteritems():
+            total += (new_value == value) - (self._simple_db.get(name) == value)
+        return total
+
+    def unset(self, name):
+        "Removes name from database if it's present."
+        self._update_value(name, None)
+
+    def top_values(self, num_values):
+        "Returns up to num_values (value, count) pairs with the highest counts (ties by value)."
+        changes = self._get_changes()
+        if not changes:
+            return self._simple_db.top_values(num_values)
+        count_changes = {}
+        for name, new_value in changes.iteritems():
+            for value, amount in ((self._simple_db.get(name), -1), (new_value, 1)):
+                if value is not None:
+                    count_changes[value] = count_changes.get(value, 0) + amount
+        # Only changed values can overtake or fall behind the shared top values, so the top values
+        # are among the changed values and enough shared top values to outnumber them.
+        values = set(value for value, amount in count_changes.iteritems() if amount)
+        values.update(value for value, _ in
+                      self._simple_db.top_values(num_values + len(values)))
+        counts = ((value, self._simple_db.count(value) + count_changes.get(value, 0))
+                  for value in values)
+        return heapq.nsmallest(num_values, ((value, count) for value, count in counts if count),
+                               key=lambda (value, count): (-count, value))
+
+    def keys_with(self, value):
+        "Returns sorted list of names that have the specified value."
+        return self._get_keys(self._simple_db.keys_with(value),
+                              lambda name, new_value: new_value == value)
+
+    def keys_in_range(self, low, high):
+        "Returns sorted list of names whose values are between low and high (inclusive)."
+        return self._get_keys(self._simple_db.keys_in_range(low, high),
+                              lambda name, new_value: low <= new_value <= high)
+
+    def keys_with_prefix(self, prefix):
+        "Returns sorted list of names that start with prefix."
+        return self._get_keys(self._simple_db.keys_with_prefix(prefix),
+                              lambda name, new_value: name.startswith(prefix))
+
+    def begin(self):
+        "Opens transaction block."
+        self._levels.append({})
+
+    def rollback(self):
+        "Rolls back most recent transaction, returning False if no open transactions."
+        if not self._levels:
+            return False
+        self._levels.pop()
+        return True
+
+    def commit(self):
+        "Commits all transactions to the shared database, returning False if none are open."
+        if not self._levels:
+            return False
+        changes = self._get_changes()
+        self._levels = []
+        self._simple_db.begin()
+        for name, value in changes.iteritems():
+            self._write(name, value)
+        self._simple_db.commit()
+        return True
+
+    def _get_keys(self, names, matches):
+        """
+            Returns sorted list of names (from the shared database), updated with names changed in
+            transactions for which matches(name, new value) holds.
+        """
+        changes = self._get_changes()
+        if not changes:
+            return names
+        names = set(names)
+        for name, value in changes.iteritems():
+            if value is not None and matches(name, value):
+                names.add(name)
+            else:
+                names.discard(name)
+        return sorted(names)
+
+    def _get_changes(self):
+        "Returns dict of the latest value (None if unset) of each name changed in transactions."
+        changes = {}
+        for level in self._levels:
+            changes.update(level)
+        return changes
+
+    def _update_value(self, name, value):
+        "Updates value in the open transaction, or in the shared database if there is none."
+        if self._levels:
+            self._levels[-1][name] = value
+        else:
+            self._write(name, value)
+
+    def _write(self, name, value):
+        "Sets (or unsets, if value is None) name in the shared database."
+        if value is None:
+            self._simple_db.unset(name)
+        else:
+            self._simple_db.put(name, value)
+
+
+class SessionHandler(asynchat.async_chat):
+
+    "Runs commands from one client connection in its own Session, sending back their output."
+
+    def __init__(self, connection, simple_db):
+        "Initialize SessionHandler instance for connection."
+        asynchat.async_chat.__init__(self, connection)
+        self.set_terminator('\n')
+        self._session = Session(simple_db)
+        self._buffer = []
+
+    def collect_incoming_data(self, data):
+        "Buffers part of a command."
+        self._buffer.append(data)
+
+    def found_terminator(self):
+        "Runs buffered command, sending its output (and closing the connection after END)."
+        command = ''.join(self._buffer)
+        self._buffer = []
+        more, output = execute_command(self._session, command)
+        if output is not None:
+            self.push(output)
+        if not more:
+            self.close_when_done()
+
+
+class SimpleDbServer(asyncore.dispatcher):
+
+    "Accepts clients on a TCP (host, port) or Unix socket address, each with its own Session."
+
+    def __init__(self, address, simple_db):
+        "Initialize SimpleDbServer instance, listening on address."
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET,
+                           socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if isinstance(address, str) and os.path.exists(address):
+            # A server killed without cleaning up leaves its socket file behind.
+            os.remove(address)
+        self.bind(address)
+        self.listen(socket.SOMAXCONN)
+        self._simple_db = simple_db
+
+    def handle_accept(self):
+        "Starts a session for a new client."
+        accepted = self.accept()
+        if accepted is not None:
+            SessionHandler(accepted[0], self._simple_db)
+
+
+def parse_address(address):
+    "Returns (host, port) for a HOST:PORT address, otherwise address (a Unix socket path)."
+    if ':' not in address:
+        return address
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
 
 
 def display(value, default=None):
-    "Prints value to stdout, or default if value is None and default is not None."
-    print value if value is not None or default is None else default
+    "Returns value as a line of output, or default if value is None and default is not None."
+    return '%s\n' % (value if value is not None or default is None else default)
+
+
+def display_names(names):
+    "Returns names as a line of output (space separated), or NULL if there are none."
+    return display(' '.join(names) or None, "NULL")
+
+
+def display_counts(value_counts):
+    "Returns a line of output per value and count pair, or NULL if there are none."
+    output = ''.join(display('%s %d' % value_count) for value_count in value_counts)
+    return output or display("NULL")
 
 
 OPS = {
@@ -109,38 +716,160 @@ OPS = {
     'GET':        (2, lambda db, command: display(db.get(command[0]), "NULL")),
     'NUMEQUALTO': (2, lambda db, command: display(db.count(command[0]))),
     'UNSET':      (2, lambda db, command: db.unset(command[0])),
+    'KEYSWITH':   (2, lambda db, command: display_names(db.keys_with(command[0]))),
+    'RANGE':      (3, lambda db, command: display_names(db.keys_in_range(*command))),
+    'PREFIX':     (2, lambda db, command: display_names(db.keys_with_prefix(command[0]))),
+    'TOPVALUES':  (2, lambda db, command: display_counts(db.top_values(int(command[0])))
+                   if command[0].isdigit() else "INVALID COMMAND\n"),
     'BEGIN':      (1, lambda db, command: db.begin()),
-    'ROLLBACK':   (1, lambda db, command: db.rollback() or display("NO TRANSACTION")),
-    'COMMIT':     (1, lambda db, command: db.commit() or display("NO TRANSACTION")),
-    'END':        (1, lambda db, command: False)
+    'ROLLBACK':   (1, lambda db, command: None if db.rollback() else display("NO TRANSACTION")),
+    'COMMIT':     (1, lambda db, command: None if db.commit() else display("NO TRANSACTION")),
+    'END':        (1, lambda db, command: None)
 }
 
 
-def process_command(simple_db, command):
-    "Applies command to the database. Returns False when stream of commands should end."
+def execute_command(simple_db, command):
+    """
+        Applies command to the database. Returns False when stream of commands should end (True
+        otherwise) and the command's output (None if it has none).
+    """
     command = command.split()
     opcode = command.pop(0).upper() if command else None
     if opcode is None or opcode not in OPS or len(command) != (OPS[opcode][0] - 1):
-        print "INVALID COMMAND"
+        return True, "INVALID COMMAND\n"
     elif 'END' == opcode:
-        return False
-    else:
-        OPS[opcode][1](simple_db, command)
-    return True
+        return False, None
+    return True, OPS[opcode][1](simple_db, command)
+
+
+def process_command(simple_db, command):
+    "Applies command to the database, printing its output. Returns False when commands should end."
+    more, output = execute_command(simple_db, command)
+    if output is not None:
+        sys.stdout.write(output)
+    return more
+
+
+def process_commands(simple_db, lines):
+    """
+        Applies commands in lines (stopping after END), grouping runs of SETs into one put_many.
+        Returns False if END was reached (True otherwise) and the commands' output.
+    """
+    output = []
+    items = []
+    more = True
+    for line in lines:
+        command = line.split()
+        if len(command) == 3 and command[0].upper() == 'SET':
+            items.append((command[1], command[2]))
+            continue
+        if items:
+            simple_db.put_many(items)
+            items = []
+        more, line_output = execute_command(simple_db, line)
+        if line_output is not None:
+            output.append(line_output)
+        if not more:
+            break
+    if items:
+        simple_db.put_many(items)
+    return more, ''.join(output)
+
 
+def run_bulk(simple_db, infile, outfile, chunk_size=BULK_CHUNK_SIZE):
+    """
+        Applies commands read from infile in chunk_size chunks until END or end of input (see
+        process_commands), writing each chunk's output to outfile in one go.
+    """
+    partial = ''
+    more = True
+    while more:
+        chunk = infile.read(chunk_size)
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        if not chunk and partial:
+            # The last line had no trailing newline.
+            lines.append(partial)
+        more, output = process_commands(simple_db, lines)
+        outfile.write(output)
+        more = more and bool(chunk)
+    outfile.flush()
 
-def run():
-    "Reads commands from the command line and passes them through for processing."
-    simple_db = SimpleDb()
-    all(iter(lambda: process_command(simple_db, raw_input()), False))
 
-run()
+def interrupt(signum, frame):
+    "Signal handler that stops the program the way Ctrl-C does (so cleanup still runs)."
+    raise KeyboardInterrupt
+
+
+def run_server(simple_db, address):
+    """
+        Serves clients at address (see SimpleDbServer) until interrupted or terminated, syncing
+        simple_db (if it's durable) every SERVER_SYNC_SECONDS.
+    """
+    SimpleDbServer(address, simple_db)
+    signal.signal(signal.SIGTERM, interrupt)
+    last_sync = time.time()
+    try:
+        while asyncore.socket_map:
+            asyncore.loop(SERVER_SYNC_SECONDS, count=1)
+            if time.time() - last_sync >= SERVER_SYNC_SECONDS:
+                if isinstance(simple_db, DurableSimpleDb):
+                    simple_db.sync()
+                last_sync = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if isinstance(address, str):
+            os.remove(address)
+
+
+def run(raw_input=raw_input):
+    """
+        Reads commands from the command line (with raw_input) and passes them through for
+        processing (persisting committed data at the path given as the first argument, if any).
+        With --bulk, reads stdin (or with --input FILE, reads FILE) in large chunks instead (see
+        run_bulk). With --serve ADDRESS (HOST:PORT or a Unix socket path), serves clients there
+        instead until interrupted. With --approximate (and no path), value counts are estimated
+        in bounded memory (see ApproximateSimpleDb).
+    """
+    arguments = sys.argv[1:]
+    address = infile = None
+    approximate = '--approximate' in arguments
+    if approximate:
+        arguments.remove('--approximate')
+    if '--serve' in arguments:
+        index = arguments.index('--serve')
+        address = parse_address(arguments[index + 1])
+        del arguments[index:index + 2]
+    if '--bulk' in arguments:
+        arguments.remove('--bulk')
+        infile = sys.stdin
+    if '--input' in arguments:
+        index = arguments.index('--input')
+        infile = open(arguments[index + 1])
+        del arguments[index:index + 2]
+    if arguments:
+        simple_db = DurableSimpleDb(arguments[0])
+    else:
+        simple_db = ApproximateSimpleDb() if approximate else SimpleDb()
+    try:
+        if infile is not None:
+            run_bulk(simple_db, infile, sys.stdout)
+        elif address is None:
+            all(iter(lambda: process_command(simple_db, raw_input()), False))
+        else:
+            run_server(simple_db, address)
+    finally:
+        if isinstance(simple_db, DurableSimpleDb):
+            simple_db.close()
+
+
+if __name__ == '__main__':
+    run()
 
 """
 # Tests
 
-# Change run def to ---- def run(raw_input=raw_input): ---- then run
-
 def fake_input(commands=None):
     "Allows faking of stdin data."
     data = ((command for command in commands.split('\n')) if commands else
@@ -159,5 +888,12 @@ run(fake_input("SET a 50 \n BEGIN \n GET a \n SET a 60 \n BEGIN \n UNSET a \n GE
                "ROLLBACK \n GET a \n COMMIT \n GET a \n END"))
 run(fake_input("SET a 10 \n BEGIN \n NUMEQUALTO 10 \n BEGIN \n UNSET a \n NUMEQUALTO 10 \n "
                "ROLLBACK \n NUMEQUALTO 10 \n COMMIT \n END"))
+# a b a b c NULL b c a c a ab
+run(fake_input("SET a 10 \n SET b 10 \n SET c 20 \n KEYSWITH 10 \n BEGIN \n SET c 10 \n "
+               "KEYSWITH 10 \n ROLLBACK \n UNSET a \n KEYSWITH 30 \n RANGE 10 20 \n "
+               "BEGIN \n SET a 15 \n SET ab 99 \n RANGE 11 20 \n PREFIX a \n END"))
+# 10 2 20 1 20 1
+run(fake_input("SET a 10 \n SET b 10 \n SET c 20 \n TOPVALUES 2 \n UNSET a \n UNSET b \n "
+               "TOPVALUES 5 \n END"))
 run(fake_input())
 """
@@ -1,17 +1,32 @@
-"Solver for 9x9 Sudoku puzzles."
+"Solver for N^2xN^2 Sudoku puzzles (9x9, with 3x3 squares, by default)."
 
 import random
-from itertools import izip, chain
+import sys
+import time
+from collections import deque
+from itertools import izip, chain, imap, islice, repeat
+from multiprocessing import Pool, cpu_count
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def are_cells_poorly_formed(cells):
-    "Returns True if cell isn't an int value between 0 and 9 (inclusive)."
-    return any(type(cell) is not int or cell < 0 or cell > 9 for cell in cells)
+BOX_SIZE = 3
+DIMENSION = BOX_SIZE * BOX_SIZE
+MAX_OPTION_COUNTS_TABLE_SIZE = 1 << 16
+BATCH_CHUNK_SIZE = 1 << 16
+DIFFICULTY_CLUES = {'easy': 36, 'medium': 30, 'hard': 26, 'expert': 17}
 
 
-def is_row_poorly_formed(row):
-    "Returns True if row isn't a list of 9 element."
-    return type(row) is not list or len(row) != 9
+def are_cells_poorly_formed(cells, dimension=DIMENSION):
+    "Returns True if cell isn't an int value between 0 and dimension (inclusive)."
+    return any(type(cell) is not int or cell < 0 or cell > dimension for cell in cells)
+
+
+def is_row_poorly_formed(row, dimension=DIMENSION):
+    "Returns True if row isn't a list of dimension elements."
+    return type(row) is not list or len(row) != dimension
 
 
 def is_value_repeated(row):
@@ -20,27 +35,67 @@ def is_value_repeated(row):
     return len(set(row)) != len(row)
 
 
-def get_square(grid, r_index, c_index):
+def get_square(grid, r_index, c_index, box_size=BOX_SIZE):
     "Returns square cell at r_index, c_index belongs to."
-    return (grid[r_index][c_index:c_index + 3]
-            + grid[r_index + 1][c_index:c_index + 3]
-            + grid[r_index + 2][c_index:c_index + 3])
+    return [cell
+            for row in grid[r_index:r_index + box_size]
+            for cell in row[c_index:c_index + box_size]]
 
 
-def get_s_index(r_index, c_index):
+def get_s_index(r_index, c_index, box_size=BOX_SIZE):
     "Returns index of square containing cell at r_index, c_index."
-    return (r_index / 3 * 3) + (c_index / 3)
+    return (r_index / box_size * box_size) + (c_index / box_size)
 
 
-def check_sudoku(grid):
+def check_sudoku(grid, box_size=BOX_SIZE):
     "Returns None if ill-formed, False if duplicates present, or True otherwise."
-    if is_row_poorly_formed(grid) or any(is_row_poorly_formed(row) or are_cells_poorly_formed(row)
-                                         for row in grid):
+    dimension = box_size * box_size
+    if is_row_poorly_formed(grid, dimension) or any(is_row_poorly_formed(row, dimension) or
+                                                    are_cells_poorly_formed(row, dimension)
+                                                    for row in grid):
         return None
+    corners = range(0, dimension, box_size)
     return (not any(is_value_repeated(row) for row in chain(grid, izip(*grid))) and
-            not any(is_value_repeated(get_square(grid, r, c))
-                    for r in [0, 3, 6]
-                    for c in [0, 3, 6]))
+            not any(is_value_repeated(get_square(grid, r, c, box_size))
+                    for r in corners
+                    for c in corners))
+
+
+def has_repeats(lines):
+    """
+        Returns boolean array marking which grids in an (N, lines, cells) array of value bits
+        (1 << value, 0 for blanks) repeat a value in a line: bits only sum to their bitwise or
+        when they are all distinct.
+    """
+    return (lines.sum(axis=2) != numpy.bitwise_or.reduce(lines, axis=2)).any(axis=1)
+
+
+def check_sudoku_batch(grids, box_size=BOX_SIZE):
+    """
+        Returns check_sudoku's result for every grid in an (N, dimension, dimension) integer array,
+        as an object array of None, False or True (all None if the array has the wrong shape or
+        dtype). Requires NumPy.
+    """
+    if numpy is None:
+        raise ImportError('check_sudoku_batch requires NumPy')
+    grids = numpy.asarray(grids)
+    dimension = box_size * box_size
+    results = numpy.empty(grids.shape[0] if grids.ndim else 0, dtype=object)
+    if (grids.ndim != 3 or grids.shape[1:] != (dimension, dimension)
+            or grids.dtype.kind not in 'iu'):
+        return results
+    for start in xrange(0, len(grids), BATCH_CHUNK_SIZE):
+        chunk = grids[start:start + BATCH_CHUNK_SIZE]
+        well_formed = ((chunk >= 0) & (chunk <= dimension)).all(axis=(1, 2))
+        bits = numpy.left_shift(1, numpy.clip(chunk, 0, dimension), dtype='int64') >> 1
+        squares = (bits.reshape(-1, box_size, box_size, box_size, box_size)
+                   .swapaxes(2, 3)
+                   .reshape(-1, dimension, dimension))
+        checked = ~(has_repeats(bits) | has_repeats(bits.swapaxes(1, 2)) | has_repeats(squares))
+        checked = checked.astype(object)
+        checked[~well_formed] = None
+        results[start:start + len(chunk)] = checked
+    return results
 
 
 def get_index_with_least_options(zeros):
@@ -85,38 +140,230 @@ def replace_zeros(grid, zeros):
     return False
 
 
-def create_metadata(rows, columns, squares, r_index, c_index):
+def create_metadata(rows, columns, squares, r_index, c_index, box_size=BOX_SIZE):
     "Returns metadata for cell at specified r_index, c_index."
-    s_index = get_s_index(r_index, c_index)
+    s_index = get_s_index(r_index, c_index, box_size)
     options = rows[r_index] & columns[c_index] & squares[s_index]
     return (options, r_index, c_index, s_index)
 
 
-def find_blank_cells(grid):
+def find_blank_cells(grid, box_size=BOX_SIZE):
     "Returns indices of all empty cells and a set of valid values for each."
-    universe = set(xrange(1, 10))
+    dimension = box_size * box_size
+    corners = range(0, dimension, box_size)
+    universe = set(xrange(1, dimension + 1))
     rows = [universe - set(row) for row in grid]
     columns = [universe - set(row) for row in izip(*grid)]
-    squares = [universe - set(get_square(grid, r, c))
-               for r in [0, 3, 6]
-               for c in [0, 3, 6]]
-    indices = range(9)
+    squares = [universe - set(get_square(grid, r, c, box_size))
+               for r in corners
+               for c in corners]
+    indices = range(dimension)
     random.shuffle(indices)
-    return [create_metadata(rows, columns, squares, r_index, c_index)
+    return [create_metadata(rows, columns, squares, r_index, c_index, box_size)
             for r_index in indices
             for c_index in indices
             if grid[r_index][c_index] == 0]
 
 
-def solve_sudoku(grid):
-    "Returns solved grid (expects 9x9 list with 0 for blank cells), or False if no solution found."
-    return check_sudoku(grid) and replace_zeros([row[:] for row in grid], find_blank_cells(grid))
+class OptionCounts(object):
+
+    "Stands in for an option count lookup table when the table would be too large."
+
+    def __getitem__(self, options):
+        "Returns number of values in options mask."
+        return bin(options).count('1')
+
+
+class BoardLayout(object):
+
+    "Unit and option tables shared by every BitmaskBoard of one box size."
+
+    _layouts = {}
+
+    def __init__(self, box_size):
+        "Initialize tables for boards with box_size x box_size squares."
+        dimension = box_size * box_size
+        self.dimension = dimension
+        self.all_options = (1 << dimension) - 1
+        self.option_counts = ([bin(options).count('1') for options in xrange(self.all_options + 1)]
+                              if self.all_options < MAX_OPTION_COUNTS_TABLE_SIZE else
+                              OptionCounts())
+        # Cell index -> (row unit, column unit, square unit), and unit -> cell indices.
+        self.cell_units = [(r_index,
+                            dimension + c_index,
+                            2 * dimension + get_s_index(r_index, c_index, box_size))
+                           for r_index in xrange(dimension)
+                           for c_index in xrange(dimension)]
+        self.unit_cells = [[] for _ in xrange(3 * dimension)]
+        for index, units in enumerate(self.cell_units):
+            for unit in units:
+                self.unit_cells[unit].append(index)
+
+    @staticmethod
+    def get(box_size):
+        "Returns (cached) layout for box_size."
+        if box_size not in BoardLayout._layouts:
+            BoardLayout._layouts[box_size] = BoardLayout(box_size)
+        return BoardLayout._layouts[box_size]
+
+
+class BitmaskBoard(object):
+
+    "Search state keeping row, column and square values as bit masks, updated in place."
+
+    def __init__(self, grid, box_size=BOX_SIZE):
+        "Initialize board from a well-formed grid without duplicates (see check_sudoku)."
+        self.layout = BoardLayout.get(box_size)
+        self.cells = [cell for row in grid for cell in row]
+        self.used = [0] * len(self.layout.unit_cells)
+        self.trail = []
+        self.blanks = [index for index, cell in enumerate(self.cells) if cell == 0]
+        for index, cell in enumerate(self.cells):
+            if cell != 0:
+                for unit in self.layout.cell_units[index]:
+                    self.used[unit] |= 1 << (cell - 1)
+
+    def to_grid(self):
+        "Returns the current cells as a list of row lists."
+        cells, dimension = self.cells, self.layout.dimension
+        return [cells[index:index + dimension] for index in xrange(0, len(cells), dimension)]
+
+    def get_options(self, index):
+        "Returns mask of values that may still be placed in the cell at index."
+        used = self.used
+        row, column, square = self.layout.cell_units[index]
+        return self.layout.all_options & ~(used[row] | used[column] | used[square])
+
+    def solutions(self):
+        "Yields the board's cells each time they form a solution (the same list, updated in place)."
+        mark = len(self.trail)
+        if self._propagate():
+            index, options = self._get_index_with_least_options()
+            if index is None:
+                yield self.cells
+            while options:
+                option = options & -options
+                options ^= option
+                self._place(index, option)
+                for solution in self.solutions():
+                    yield solution
+                self._undo(len(self.trail) - 1)
+        self._undo(mark)
+
+    def _place(self, index, option):
+        "Sets cell at index to the value of single-bit mask option, recording it for undo."
+        self.cells[index] = option.bit_length()
+        used = self.used
+        for unit in self.layout.cell_units[index]:
+            used[unit] |= option
+        self.trail.append(index)
+
+    def _undo(self, mark):
+        "Blanks every cell placed since the trail had length mark."
+        cells, used, trail = self.cells, self.used, self.trail
+        while len(trail) > mark:
+            index = trail.pop()
+            option = 1 << (cells[index] - 1)
+            cells[index] = 0
+            for unit in self.layout.cell_units[index]:
+                used[unit] ^= option
+
+    def _get_index_with_least_options(self):
+        "Returns index of blank cell with the least options and its options, or None if full."
+        cells, used, layout = self.cells, self.used, self.layout
+        cell_units, all_options, option_counts = (layout.cell_units, layout.all_options,
+                                                  layout.option_counts)
+        z_index, best, best_options = None, layout.dimension + 1, 0
+        for index in self.blanks:
+            if cells[index] == 0:
+                row, column, square = cell_units[index]
+                options = all_options & ~(used[row] | used[column] | used[square])
+                num_options = option_counts[options]
+                if num_options < best:
+                    z_index, best, best_options = index, num_options, options
+        return z_index, best_options
+
+    def _propagate(self):
+        "Places naked and hidden singles until none remain. Returns False on contradiction."
+        cells, used, layout = self.cells, self.used, self.layout
+        cell_units, all_options, option_counts = (layout.cell_units, layout.all_options,
+                                                  layout.option_counts)
+        changed = True
+        while changed:
+            changed = False
+            for index in self.blanks:
+                if cells[index] == 0:
+                    row, column, square = cell_units[index]
+                    options = all_options & ~(used[row] | used[column] | used[square])
+                    if not options:
+                        return False
+                    if option_counts[options] == 1:
+                        self._place(index, options)
+                        changed = True
+            if changed:
+                continue
+            for unit, members in enumerate(layout.unit_cells):
+                once = twice = 0
+                for index in members:
+                    if cells[index] == 0:
+                        row, column, square = cell_units[index]
+                        options = all_options & ~(used[row] | used[column] | used[square])
+                        twice |= once & options
+                        once |= options
+                if once | used[unit] != all_options:
+                    return False
+                hidden = once & ~twice
+                while hidden:
+                    option = hidden & -hidden
+                    hidden ^= option
+                    for index in members:
+                        if cells[index] == 0 and self.get_options(index) & option:
+                            self._place(index, option)
+                            changed = True
+                            break
+        return True
+
+
+def solve_sudoku(grid, box_size=BOX_SIZE):
+    """
+        Returns solved grid (expects box_size^2 x box_size^2 list with 0 for blank cells), or False
+        if no solution found.
+    """
+    valid = check_sudoku(grid, box_size)
+    if not valid:
+        return valid
+    board = BitmaskBoard(grid, box_size)
+    return next(board.solutions(), False) and board.to_grid()
+
+
+def iter_solutions(grid, box_size=BOX_SIZE):
+    "Yields every solution of grid. The same yielded grid is refilled in place for each solution."
+    if not check_sudoku(grid, box_size):
+        return
+    dimension = box_size * box_size
+    solution = [row[:] for row in grid]
+    for cells in BitmaskBoard(grid, box_size).solutions():
+        for r_index, row in enumerate(solution):
+            row[:] = cells[r_index * dimension:(r_index + 1) * dimension]
+        yield solution
+
+
+def count_solutions(grid, limit=None, box_size=BOX_SIZE):
+    "Returns number of solutions of grid (0 if ill-formed), stopping early once limit is reached."
+    if not check_sudoku(grid, box_size):
+        return 0
+    return sum(1 for _ in islice(BitmaskBoard(grid, box_size).solutions(), limit))
+
+
+def solve_many(grids):
+    "Yields solve_sudoku's result for each grid in grids, solving lazily as results are consumed."
+    return imap(solve_sudoku, grids)
 
 
-def generate_puzzle():
-    "Returns a randomly generated puzzle (about 5-6% will have no solution)."
-    dimension = 9
-    max_num_cells_to_populate = 17
+def generate_puzzle(box_size=BOX_SIZE):
+    "Returns a randomly generated puzzle (for 9x9, about 5-6% will have no solution)."
+    dimension = box_size * box_size
+    max_num_cells_to_populate = 2 * dimension - 1
     puzzle = [[0] * dimension for _ in xrange(dimension)]
     available = range(dimension * dimension)
     rows, columns, squares = [[set(xrange(1, dimension + 1)) for _ in xrange(dimension)]
@@ -126,7 +373,7 @@ def generate_puzzle():
         available.pop(index)
         r_index = index / dimension
         c_index = index % dimension
-        s_index = get_s_index(r_index, c_index)
+        s_index = get_s_index(r_index, c_index, box_size)
         options = rows[r_index] & columns[c_index] & squares[s_index]
         if len(options) < 1:
             break
@@ -135,4 +382,181 @@ def generate_puzzle():
         any(cache.discard(value) for cache in [rows[r_index], columns[c_index], squares[s_index]])
     return puzzle
 
+
+def has_unique_solution(grid, box_size=BOX_SIZE):
+    "Returns True if grid has exactly one solution (stops searching at the second)."
+    return count_solutions(grid, 2, box_size) == 1
+
+
+def get_shuffled_line_order(box_size=BOX_SIZE):
+    "Returns a random row (or column) order that keeps every band of squares together."
+    bands = range(box_size)
+    random.shuffle(bands)
+    order = []
+    for band in bands:
+        offsets = range(box_size)
+        random.shuffle(offsets)
+        order += [band * box_size + offset for offset in offsets]
+    return order
+
+
+def generate_solution(box_size=BOX_SIZE):
+    """
+        Returns a randomly generated, completely solved grid.
+
+        Solves a grid seeded with a random first row (always completable), then shuffles rows and
+        columns within and between bands. Unlike seeding random clues, this never produces an
+        unsolvable grid, whose exhaustive search gets very expensive on large boards.
+    """
+    dimension = box_size * box_size
+    first_row = range(1, dimension + 1)
+    random.shuffle(first_row)
+    solution = solve_sudoku([first_row] + [[0] * dimension for _ in xrange(dimension - 1)],
+                            box_size)
+    rows = [solution[r_index] for r_index in get_shuffled_line_order(box_size)]
+    c_order = get_shuffled_line_order(box_size)
+    return [[row[c_index] for c_index in c_order] for row in rows]
+
+
+def generate_unique_puzzle(num_clues=None, difficulty='hard', box_size=BOX_SIZE):
+    """
+        Returns a random puzzle with exactly one solution.
+
+        Clues are removed from a random solved grid in random order, skipping any removal that
+        would allow a second solution, until num_clues remain (or the DIFFICULTY_CLUES target
+        for difficulty, scaled to the board size, if num_clues is None) or no further clue can be
+        removed.
+    """
+    dimension = box_size * box_size
+    num_remaining = dimension * dimension
+    target = (DIFFICULTY_CLUES[difficulty] * num_remaining / (DIMENSION * DIMENSION)
+              if num_clues is None else num_clues)
+    puzzle = generate_solution(box_size)
+    indices = range(num_remaining)
+    random.shuffle(indices)
+    for index in indices:
+        if num_remaining <= target:
+            break
+        r_index, c_index = divmod(index, dimension)
+        value = puzzle[r_index][c_index]
+        puzzle[r_index][c_index] = 0
+        if has_unique_solution(puzzle, box_size):
+            num_remaining -= 1
+        else:
+            puzzle[r_index][c_index] = value
+    return puzzle
+
+
+def _generate_unique_puzzle(args):
+    "Unpacks arguments for generate_unique_puzzle (for use with Pool.imap)."
+    return generate_unique_puzzle(*args)
+
+
+def generate_many(num_puzzles, num_clues=None, difficulty='hard', processes=None,
+                  box_size=BOX_SIZE):
+    "Yields num_puzzles unique-solution puzzles (see generate_unique_puzzle) generated in parallel."
+    pool = Pool(processes or cpu_count(), random.seed)
+    try:
+        for puzzle in pool.imap_unordered(_generate_unique_puzzle,
+                                          repeat((num_clues, difficulty, box_size), num_puzzles),
+                                          chunksize=16):
+            yield puzzle
+    finally:
+        pool.terminate()
+
+
+def parse_puzzle(line):
+    "Returns grid for an 81-character puzzle line ('0' or '.' for blanks), or None if malformed."
+    line = line.strip()
+    if len(line) != DIMENSION * DIMENSION or any(cell not in '.0123456789' for cell in line):
+        return None
+    cells = [0 if cell == '.' else int(cell) for cell in line]
+    return [cells[index:index + DIMENSION] for index in xrange(0, len(cells), DIMENSION)]
+
+
+def format_puzzle(grid):
+    "Returns grid as an 81-character line."
+    return ''.join(str(cell) for row in grid for cell in row)
+
+
+def solve_lines(lines):
+    "Returns an output line for each puzzle line: its solution, INVALID PUZZLE or NO SOLUTION."
+    results = []
+    for line in lines:
+        grid = parse_puzzle(line)
+        if grid is None or not check_sudoku(grid):
+            results.append('INVALID PUZZLE\n')
+        else:
+            solution = solve_sudoku(grid)
+            results.append(format_puzzle(solution) + '\n' if solution else 'NO SOLUTION\n')
+    return results
+
+
+def solve_file(infile, outfile, processes=None, chunk_size=1000):
+    "Streams solutions of infile's puzzles to outfile, in order. Returns (num_puzzles, seconds)."
+    processes = processes or cpu_count()
+    max_pending = 2 * processes
+    start = time.time()
+    num_puzzles = 0
+    chunks = iter(lambda: list(islice(infile, chunk_size)), [])
+    pending = deque()
+    pool = Pool(processes)
+    try:
+        for chunk in chunks:
+            num_puzzles += len(chunk)
+            pending.append(pool.apply_async(solve_lines, (chunk,)))
+            if len(pending) >= max_pending:
+                outfile.writelines(pending.popleft().get())
+        while pending:
+            outfile.writelines(pending.popleft().get())
+    finally:
+        pool.terminate()
+    return num_puzzles, time.time() - start
+
+
+def generate_file(outfile, num_puzzles, num_clues=None, difficulty='hard', processes=None):
+    "Writes num_puzzles unique-solution puzzles to outfile. Returns (num_puzzles, seconds)."
+    start = time.time()
+    outfile.writelines(format_puzzle(puzzle) + '\n'
+                       for puzzle in generate_many(num_puzzles, num_clues, difficulty, processes))
+    return num_puzzles, time.time() - start
+
+
+def run():
+    """
+        Solves puzzles from the file named by the first argument, writing to stdout or the second
+        argument. With --generate COUNT [DIFFICULTY|NUM_CLUES], writes new puzzles to stdout.
+        Writes the usage to stderr instead if the arguments are missing or not valid.
+    """
+    usage = ('usage: %s PUZZLE_FILE [SOLUTION_FILE]\n'
+             '       %s --generate COUNT [DIFFICULTY|NUM_CLUES]\n'
+             'DIFFICULTY is one of %s (default hard)\n'
+             % (sys.argv[0], sys.argv[0],
+                ', '.join(sorted(DIFFICULTY_CLUES, key=DIFFICULTY_CLUES.get, reverse=True))))
+    if len(sys.argv) < 2:
+        sys.stderr.write(usage)
+        return
+    if sys.argv[1] == '--generate':
+        level = sys.argv[3] if len(sys.argv) > 3 else 'hard'
+        if (len(sys.argv) < 3 or not sys.argv[2].isdigit()
+                or not (level.isdigit() or level in DIFFICULTY_CLUES)):
+            sys.stderr.write(usage)
+            return
+        num_clues, difficulty = (int(level), None) if level.isdigit() else (None, level)
+        num_puzzles, seconds = generate_file(sys.stdout, int(sys.argv[2]), num_clues, difficulty)
+    else:
+        with open(sys.argv[1], 'r') as infile:
+            outfile = open(sys.argv[2], 'w') if len(sys.argv) > 2 else sys.stdout
+            try:
+                num_puzzles, seconds = solve_file(infile, outfile)
+            finally:
+                if outfile is not sys.stdout:
+                    outfile.close()
+    sys.stderr.write('%d puzzles in %.2f seconds (%.1f puzzles/second)\n'
+                     % (num_puzzles, seconds, num_puzzles / seconds if seconds else 0.0))
+
+
+if __name__ == '__main__':
+    run()
+
 # print solve_sudoku(generate_puzzle())